@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+End-to-end poll cycle benchmark.
+Runs DbusMppSolarService for several simulated inverters on a private D-Bus
+session bus, each backed by an inverterd simulator, and reports the poll
+cycle latency percentiles, commands per second and CPU time per device, and
+the CPU time of the whole process.
+
+Usage: bench_poll.py [--devices 2] [--duration 60] [--interval 1000] [--sync] [--latency 50] [--backend hidraw]
+
+With --backend hidraw the service talks P18 to simulated devices on pseudo
+terminals instead of going through inverterd.
+
+Needs dbus-daemon, dbus-python, PyGObject and velib_python, as on a GX device.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(1, os.path.dirname(__file__))
+import inverterd_sim
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def start_session_bus():
+    bus = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address=1'],
+                           stdout=subprocess.PIPE, text=True)
+    os.environ['DBUS_SESSION_BUS_ADDRESS'] = bus.stdout.readline().strip()
+    return bus
+
+def load_service_module():
+    spec = importlib.util.spec_from_file_location('dbus_mppsolar', os.path.join(ROOT, 'dbus-mppsolar.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def thread_cpu(thread):
+    """CPU time (user + system) of a live thread, in seconds, from /proc."""
+    try:
+        with open(f'/proc/self/task/{thread.native_id}/stat') as stat:
+            # Fields after the command name, which may contain spaces
+            fields = stat.read().rsplit(')', 1)[1].split()
+    except (OSError, AttributeError):
+        return 0.0
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def device_cpu(service):
+    """CPU time of the threads working for one service: its poll worker and its command queue."""
+    threads = set(getattr(getattr(service, '_executor', None), '_threads', ()))
+    if service._inverter.queue._thread is not None:
+        threads.add(service._inverter.queue._thread)
+    return sum(thread_cpu(thread) for thread in threads)
+
+class CycleProbe(object):
+    """
+    Collects every poll cycle duration of one service, from the tick to the
+    end of publishing, as the service itself measures it for /Mgmt/Stats.
+    The poll timer holds the service's own bound methods, so the durations
+    are taken where the service hands them to its statistics.
+    """
+    def __init__(self, service):
+        self.cycles = []
+        stats = service._inverter.stats
+        cycle_done = stats.cycle_done
+
+        def recorded_cycle_done(seconds, period):
+            self.cycles.append(seconds)
+            return cycle_done(seconds, period)
+
+        stats.cycle_done = recorded_cycle_done
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices","-n", type=int, default=1)
+    parser.add_argument("--duration","-d", type=float, default=60, help="seconds")
+    parser.add_argument("--interval","-i", type=int, default=1000, help="updateInterval, in ms")
+    parser.add_argument("--sync", dest='asyncPoll', action='store_false', help="poll from the main loop (asyncPoll false)")
+    parser.add_argument("--latency", type=float, default=0, help="simulated inverter latency, in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="simulated random extra latency, in ms")
+    parser.add_argument("--hang-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--config", type=str, help="config.json entries to merge into every simulated device")
+    parser.add_argument("--port", type=int, default=18305, help="first simulator port")
+    parser.add_argument("--backend", choices=('inverterd', 'hidraw'), default='inverterd')
+    args = parser.parse_args()
+
+    bus = start_session_bus()
+    workdir = tempfile.mkdtemp(prefix='bench-mppsolar-')
+    servers = []
+    try:
+        extra = {}
+        if args.config:
+            with open(args.config, 'r') as config_file:
+                extra = json.load(config_file)
+
+        # Fake hidraw nodes: plain files the service only checks for with
+        # inverterd, links to the simulated P18 devices with the hidraw backend
+        config = {}
+        simulators = []
+        for n in range(args.devices):
+            simulator = inverterd_sim.Simulator(args.latency, args.jitter, args.hang_rate, args.error_rate)
+            simulators.append(simulator)
+            tty = os.path.join(workdir, f'hidraw{n}')
+            if args.backend == 'hidraw':
+                device = inverterd_sim.P18Device(simulator)
+                servers.append(device)
+                os.symlink(device.path, tty)
+            else:
+                servers.append(inverterd_sim.start(args.port + n, simulator))
+                open(tty, 'w').close()
+            config[tty] = dict({'productname': f'Bench {n}', 'deviceinstance': args.port - 8305 + n,
+                                'updateInterval': args.interval, 'asyncPoll': args.asyncPoll,
+                                'backend': args.backend, 'historyFile': None}, **extra)
+        config_path = os.path.join(workdir, 'config.json')
+        with open(config_path, 'w') as config_file:
+            json.dump(config, config_file)
+
+        mpp = load_service_module()
+        # The simulators stand in for inverterd, only the readiness probe runs
+        mpp.InverterdSupervisor._spawn = lambda self: None
+
+        from gi.repository import GLib
+        from dbus.mainloop.glib import DBusGMainLoop
+        DBusGMainLoop(set_as_default=True)
+        mpp.mainloop = GLib.MainLoop()
+
+        services = [mpp.DbusMppSolarService(tty=tty, deviceinstance=0, json_file_path=config_path) for tty in config]
+        probes = [CycleProbe(service) for service in services]
+
+        GLib.timeout_add(int(args.duration * 1000), mpp.mainloop.quit)
+        cpu, wall, main_cpu = time.process_time(), time.monotonic(), thread_cpu(threading.main_thread())
+        mpp.mainloop.run()
+        cpu, wall = time.process_time() - cpu, time.monotonic() - wall
+        main_cpu = thread_cpu(threading.main_thread()) - main_cpu
+
+        print(f"{args.devices} device(s), {wall:.1f} s, updateInterval {args.interval} ms, "
+              f"{'async' if args.asyncPoll else 'sync'} poll, {args.backend} backend, simulated latency {args.latency} ms")
+        print(f"{'device':<10} {'cycles':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'cmd/s':>7} {'cpu s':>7}")
+        for n, (service, probe, simulator) in enumerate(zip(services, probes, simulators)):
+            cycles = [c * 1000 for c in probe.cycles]
+            print(f"{'hidraw' + str(n):<10} {len(cycles):>7} {percentile(cycles, 50):>8.1f} {percentile(cycles, 90):>8.1f} "
+                  f"{percentile(cycles, 99):>8.1f} {max(cycles, default=float('nan')):>8.1f} "
+                  f"{simulator.commands / wall:>7.1f} {device_cpu(service):>7.2f}")
+        # Per device: its poll worker and command queue threads. Publishing
+        # runs on the shared main loop (so does the whole poll with --sync)
+        print(f"process CPU time {cpu:.2f} s ({100 * cpu / wall:.1f} %), of which main loop {main_cpu:.2f} s")
+    finally:
+        for server in servers:
+            if isinstance(server, inverterd_sim.P18Device):
+                server.close()
+            else:
+                server.shutdown()
+        bus.terminate()
+
+if __name__ == "__main__":
+    main()
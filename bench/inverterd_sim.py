@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for inverterd.
+Speaks inverterd's line protocol on TCP and answers the P18 commands used by
+dbus-mppsolar with canned or scripted responses. Latency, hangs and errors
+can be injected to reproduce a slow or failing inverter without hardware.
+
+Usage: inverterd_sim.py --port 8305 [--latency 50] [--hang-rate 0.01] [--script responses.json]
+
+A script is a JSON object mapping a command to one response (the "data"
+part) or to a list of responses, played in a loop. A command may also be
+given as {"responses": [...], "latency": ms, "hang-rate": p, "error-rate": p}
+to override the global injection settings for that command only.
+
+With --p18, the simulator is a P18 device on a pseudo terminal instead, for
+the native hidraw backend. Its answers are the canned P18_ANSWERS below,
+scripts only change the injected faults.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import socketserver
+import threading
+import time
+import tty
+
+STATUS = {
+    "grid_voltage": {"value": 230.1, "unit": "V"},
+    "grid_freq": {"value": 50.0, "unit": "Hz"},
+    "ac_output_voltage": {"value": 229.8, "unit": "V"},
+    "ac_output_freq": {"value": 50.0, "unit": "Hz"},
+    "ac_output_apparent_power": {"value": 812, "unit": "VA"},
+    "ac_output_active_power": {"value": 745, "unit": "W"},
+    "output_load_percent": {"value": 14, "unit": "%"},
+    "battery_voltage": {"value": 52.4, "unit": "V"},
+    "battery_voltage_scc": {"value": 52.4, "unit": "V"},
+    "battery_voltage_scc2": {"value": 0.0, "unit": "V"},
+    "battery_discharge_current": {"value": 0, "unit": "A"},
+    "battery_charge_current": {"value": 18, "unit": "A"},
+    "battery_capacity": {"value": 87, "unit": "%"},
+    "inverter_heat_sink_temp": {"value": 41, "unit": "°C"},
+    "mppt1_charger_temperature": {"value": 38, "unit": "°C"},
+    "mppt2_charger_temperature": {"value": 0, "unit": "°C"},
+    "pv1_input_power": {"value": 1710, "unit": "W"},
+    "pv2_input_power": {"value": 0, "unit": "W"},
+    "pv1_input_voltage": {"value": 312.5, "unit": "V"},
+    "pv2_input_voltage": {"value": 0.0, "unit": "V"},
+    "mppt1_charger_status": "MPPT",
+    "mppt2_charger_status": "Abnormal",
+    "load_connected": "Connected",
+    "battery_power_direction": "Charge",
+    "dc_ac_power_direction": "DC/AC",
+    "line_power_direction": "Do nothing",
+    "local_parallel_id": 0,
+}
+
+RATED = {
+    "ac_input_rating_voltage": {"value": 230.0, "unit": "V"},
+    "ac_input_rating_current": {"value": 21.7, "unit": "A"},
+    "ac_output_rating_voltage": {"value": 230.0, "unit": "V"},
+    "ac_output_rating_freq": {"value": 50.0, "unit": "Hz"},
+    "ac_output_rating_current": {"value": 21.7, "unit": "A"},
+    "ac_output_rating_apparent_power": {"value": 5000, "unit": "VA"},
+    "ac_output_rating_active_power": {"value": 5000, "unit": "W"},
+    "battery_rating_voltage": {"value": 48.0, "unit": "V"},
+    "battery_recharge_voltage": {"value": 46.0, "unit": "V"},
+    "battery_redischarge_voltage": {"value": 54.0, "unit": "V"},
+    "battery_under_voltage": {"value": 42.0, "unit": "V"},
+    "battery_bulk_voltage": {"value": 56.4, "unit": "V"},
+    "battery_float_voltage": {"value": 54.0, "unit": "V"},
+    "battery_type": "User",
+    "max_ac_charging_current": {"value": 30, "unit": "A"},
+    "max_charging_current": {"value": 60, "unit": "A"},
+}
+
+ERRORS = {
+    "fault_code": 0,
+    "line_fail": False,
+    "output_circuit_short": False,
+    "inverter_over_temperature": False,
+    "fan_lock": False,
+    "battery_voltage_high": False,
+    "battery_low": False,
+    "battery_under": False,
+    "over_load": False,
+    "eeprom_fail": False,
+    "power_limit": False,
+    "pv1_voltage_high": False,
+    "pv2_voltage_high": False,
+    "mppt1_overload_warning": False,
+    "mppt2_overload_warning": False,
+    "battery_too_low_to_charge_for_scc1": False,
+    "battery_too_low_to_charge_for_scc2": False,
+}
+
+RESPONSES = {
+    "get-protocol-id": {"id": 18},
+    "get-serial-number": {"serial": "96332309100452"},
+    "get-cpu-version": {"main_cpu_version": "00006.11", "slave1_cpu_version": "00003.22", "slave2_cpu_version": "00000.00"},
+    "get-status": STATUS,
+    "get-mode": {"mode": "Battery mode"},
+    "get-rated": RATED,
+    "get-errors": ERRORS,
+    "get-total-generated": {"wh": 4523100},
+    "get-day-generated": {"wh": 8420},
+}
+
+class Behaviour(object):
+    """Responses and injected faults for one command."""
+    def __init__(self, responses, latency, jitter, hang_rate, error_rate):
+        self.responses = itertools.cycle(responses if isinstance(responses, list) else [responses])
+        self.latency = latency
+        self.jitter = jitter
+        self.hang_rate = hang_rate
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+
+    def next_response(self):
+        with self._lock:
+            return next(self.responses)
+
+class Simulator(object):
+    """Command table and counters shared by every client connection."""
+    def __init__(self, latency=0, jitter=0, hang_rate=0.0, error_rate=0.0, script=None):
+        self.defaults = dict(latency=latency, jitter=jitter, hang_rate=hang_rate, error_rate=error_rate)
+        self.behaviours = {}
+        for command, responses in dict(RESPONSES, **(script or {})).items():
+            self.behaviours[command] = self._behaviour(responses)
+
+        # Counters
+        self.commands = 0
+        self.hangs = 0
+        self.errors = 0
+
+    def _behaviour(self, responses):
+        settings = dict(self.defaults)
+        if isinstance(responses, dict) and 'responses' in responses:
+            settings['latency'] = responses.get('latency', settings['latency'])
+            settings['jitter'] = responses.get('jitter', settings['jitter'])
+            settings['hang_rate'] = responses.get('hang-rate', settings['hang_rate'])
+            settings['error_rate'] = responses.get('error-rate', settings['error_rate'])
+            responses = responses['responses']
+        return Behaviour(responses, **settings)
+
+    def execute(self, command, args):
+        """Return (ok, payload), or None to never answer."""
+        self.commands += 1
+        behaviour = self.behaviours.get(command)
+        if behaviour is None:
+            if command.startswith('set-'):
+                behaviour = self.behaviours[command] = self._behaviour({"result": "ok"})
+            else:
+                return False, f"unknown command '{command}'"
+
+        delay = behaviour.latency + random.uniform(0, behaviour.jitter)
+        if delay:
+            time.sleep(delay / 1000)
+        if behaviour.hang_rate and random.random() < behaviour.hang_rate:
+            self.hangs += 1
+            return None
+        if behaviour.error_rate and random.random() < behaviour.error_rate:
+            self.errors += 1
+            return False, "simulated inverter error"
+        return True, json.dumps({"result": "ok", "data": behaviour.next_response()})
+
+def simple_table(payload):
+    # JSON answer -> inverterd's simple-table format, "key value [unit]" per line
+    lines = []
+    for key, value in json.loads(payload).get('data', {}).items():
+        if isinstance(value, dict):
+            lines.append(f"{key} {value['value']} {value['unit']}")
+        elif isinstance(value, bool):
+            lines.append(f"{key} {'true' if value else 'false'}")
+        else:
+            lines.append(f"{key} {value}")
+    return '\r\n'.join(lines)
+
+class Handler(socketserver.StreamRequestHandler):
+    def _reply(self, ok, payload=''):
+        self.wfile.write(('ok' if ok else 'err').encode() + b'\r\n' + payload.encode() + b'\r\n\r\n')
+
+    def handle(self):
+        simulator = self.server.simulator
+        fmt = 'json'
+        for raw in self.rfile:
+            words = raw.decode().strip().split()
+            if not words:
+                continue
+            if words[0] == 'v':
+                self._reply(True)
+            elif words[0] == 'format':
+                fmt = words[1] if len(words) > 1 else fmt
+                self._reply(True)
+            elif words[0] == 'exec' and len(words) > 1:
+                result = simulator.execute(words[1], words[2:])
+                if result is None:
+                    # Hung inverter: swallow everything until the client gives up
+                    for _ in self.rfile:
+                        pass
+                    return
+                ok, payload = result
+                if ok and fmt == 'simple-table':
+                    payload = simple_table(payload)
+                self._reply(ok, payload)
+            else:
+                self._reply(False, f"unknown request '{words[0]}'")
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port, simulator, host='127.0.0.1'):
+        self.simulator = simulator
+        super().__init__((host, port), Handler)
+
+def start(port, simulator, host='127.0.0.1'):
+    """Serve in a background thread, returns the server (call shutdown() to stop)."""
+    server = Server(port, simulator, host)
+    threading.Thread(target=server.serve_forever, name=f'inverterd-sim-{port}', daemon=True).start()
+    return server
+
+# Raw P18 answers, with the same values as the inverterd responses above
+P18_ANSWERS = {
+    'PI': '18',
+    'ID': '1496332309100452000000',
+    'VFW': '00006,00003,00000',
+    'ET': '04523100',
+    'ED': '08420',
+    'GS': '2301,500,2298,500,0812,0745,014,524,524,000,000,018,087,041,038,000,1710,0000,3125,0000,0,2,0,1,1,2,0,0',
+    'MOD': '03',
+    'PIRI': '2300,217,2300,500,217,5000,5000,480,460,540,420,564,540,2,30,060,0,0,1,9,0,0,0,0,1',
+    'FWS': '00,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0',
+}
+# P18 query code -> inverterd command, for the simulator counters and faults
+P18_QUERIES = {
+    'PIRI': 'get-rated', 'PI': 'get-protocol-id', 'ID': 'get-serial-number', 'VFW': 'get-cpu-version',
+    'ET': 'get-total-generated', 'ED': 'get-day-generated', 'GS': 'get-status', 'MOD': 'get-mode', 'FWS': 'get-errors',
+}
+
+def p18_crc(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1
+    high, low = (crc >> 8) & 0xFF, crc & 0xFF
+    high += high in (0x28, 0x0d, 0x0a)
+    low += low in (0x28, 0x0d, 0x0a)
+    return bytes((high, low))
+
+def p18_frame(head):
+    frame = head.encode('ascii')
+    return frame + p18_crc(frame) + b'\r'
+
+class P18Device(object):
+    """A P18 inverter on a pseudo terminal, `path` stands in for /dev/hidrawX."""
+    REPORT = 8
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self._master, slave = os.openpty()
+        tty.setraw(slave)
+        self.path = os.ttyname(slave)
+        self._slave = slave
+        self.crcErrors = 0
+        threading.Thread(target=self._serve, name='p18-sim', daemon=True).start()
+
+    def _answer(self, request):
+        if p18_crc(request[:-3]) != request[-3:-1]:
+            self.crcErrors += 1
+            return p18_frame('^0')
+        kind, body = request[1:2], request[5:-3].decode('ascii')
+        if kind == b'S':
+            result = self.simulator.execute('set-' + body.rstrip('0123456789,').lower(), [])
+            return None if result is None else p18_frame('^1' if result[0] else '^0')
+        code = next((code for code in P18_QUERIES if body.startswith(code)), None)
+        if code is None:
+            return p18_frame('^0')
+        result = self.simulator.execute(P18_QUERIES[code], [])
+        if result is None:
+            return None
+        if not result[0]:
+            return p18_frame('^0')
+        data = P18_ANSWERS[code]
+        return p18_frame(f'^D{len(data) + 3:03d}{data}')
+
+    def _serve(self):
+        buffer = b''
+        while True:
+            try:
+                buffer += os.read(self._master, 256)
+            except OSError:
+                return
+            while b'\r' in buffer:
+                request, buffer = buffer.split(b'\r', 1)
+                answer = self._answer(request + b'\r')
+                # Answered as zero padded HID reports
+                for start in range(0, len(answer or b''), self.REPORT):
+                    os.write(self._master, answer[start:start + self.REPORT].ljust(self.REPORT, b'\0'))
+
+    def close(self):
+        os.close(self._master)
+        os.close(self._slave)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port","-p", type=int, default=8305)
+    parser.add_argument("--latency", type=float, default=0, help="delay of every answer, in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="random extra delay, in ms")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="probability of never answering")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of answering an error")
+    parser.add_argument("--script", type=str, help="JSON file of scripted responses")
+    parser.add_argument("--p18", action='store_true', help="be a P18 device on a pseudo terminal instead of inverterd")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    script = None
+    if args.script:
+        with open(args.script, 'r') as script_file:
+            script = json.load(script_file)
+
+    simulator = Simulator(args.latency, args.jitter, args.hang_rate, args.error_rate, script)
+    if args.p18:
+        device = P18Device(simulator)
+        logging.info(f"P18 simulator on {device.path}, use it as the hidraw path with \"backend\": \"hidraw\"")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        logging.info(f"{simulator.commands} commands, {simulator.hangs} hangs, {simulator.errors} errors, {device.crcErrors} CRC errors")
+        return
+    server = Server(args.port, simulator)
+    logging.info(f"inverterd simulator listening on port {args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    logging.info(f"{simulator.commands} commands, {simulator.hangs} hangs, {simulator.errors} errors")
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,6 @@ via VRM of the features.
 VERSION = 'v0.2' 
 
 from gi.repository import GLib
-import platform
 import argparse
 import logging
 import sys
@@ -18,11 +17,20 @@ from enum import Enum
 import datetime
 import dbus
 import dbus.service
-import subprocess
 import time
 import atexit
+import collections
+import gc
+import heapq
+import itertools
+import math
+import mmap
+import signal
+import socket
+import struct
+import threading
 import concurrent.futures
-from inverterd import Client, Format
+from inverterd import Client, Format, InverterError
 
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
@@ -30,148 +38,1765 @@ logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s -
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), 'velib_python'))
 from vedbus import VeDbusService, VeDbusItemExport, VeDbusItemImport
 
-process = None
-port = None
 host = '127.0.0.1'
-usb_path = ''
 output_format=Format.JSON
 
-# For production history
-energyProductionDays = None
-currentDay = None
-minBatteryVoltage = None
-maxBatteryVoltage = None
-maxBatteryCurrent = None
-maxPVPower = None
-maxPVVoltage = None
-
-numberOfChargers = 1
-
-def start_inverterd(usb_path: str):
-    global process
-    global port
-
-    process = subprocess.Popen(
-        ['/data/etc/dbus-mppsolar/inverterd', '--usb-path', usb_path, '--port', str(port), '--delay 1000'],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    return process
-
-def stop_inverterd():
-    if process:
+class Inverter(object):
+    """
+    One inverter and the inverterd instance serving it.
+    Everything that is specific to a device lives here, so that a single
+    process can drive several inverters.
+    """
+    def __init__(self, usb_path, port, host='127.0.0.1', numberOfChargers=1, inverterdDelay=1000, backend='inverterd', hidrawDelay=100, outputFormat=None):
+        self.usb_path = usb_path
+        self.port = port
+        self.host = host
+        self.format = Format(outputFormat) if outputFormat else output_format
+        if self.format == Format.TABLE:
+            logging.warning("The table output format is meant for humans, using simple-table")
+            self.format = Format.SIMPLE_TABLE
+        self.numberOfChargers = numberOfChargers
+        # In-process P18 link to the hidraw device instead of an inverterd instance
+        self.transport = P18Transport(usb_path, hidrawDelay) if backend == 'hidraw' else None
+        self.supervisor = InverterdSupervisor(self, inverterdDelay)
+        self.queue = CommandQueue(self)
+        self.setpoints = SetpointCache(self)
+        self.stats = PollStats()
+
+    def __repr__(self):
+        return f"Inverter({self.usb_path}, port {self.port})"
+
+class PollStats(object):
+    """
+    Timings and counters of one inverter's polling, published under /Mgmt/Stats.
+    Command timings are recorded from the poll worker, everything is plain
+    ints and floats so it can be read from the main loop at any time.
+    """
+    BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)    # ms, plus an overflow bucket
+
+    def __init__(self):
+        self.commands = {}
+        self.timeouts = 0
+        self.restarts = 0
+        self.cycles = 0
+        self.overruns = 0
+        self.lastCycleMs = 0
+        self.maxCycleMs = 0
+        self.lastSuccess = None
+
+    def command_done(self, command, seconds, ok):
+        stats = self.commands.get(command)
+        if stats is None:
+            stats = self.commands[command] = {'count': 0, 'errors': 0, 'totalMs': 0.0, 'maxMs': 0.0,
+                                              'histogram': [0] * (len(self.BUCKETS) + 1), 'lastSuccess': None}
+        ms = seconds * 1000
+        stats['count'] += 1
+        stats['totalMs'] += ms
+        stats['maxMs'] = max(stats['maxMs'], ms)
+        stats['histogram'][next((n for n, bound in enumerate(self.BUCKETS) if ms <= bound), len(self.BUCKETS))] += 1
+        if ok:
+            stats['lastSuccess'] = time.time()
+        else:
+            stats['errors'] += 1
+
+    def cycle_done(self, seconds, period):
+        self.cycles += 1
+        self.lastCycleMs = seconds * 1000
+        self.maxCycleMs = max(self.maxCycleMs, self.lastCycleMs)
+        if self.lastCycleMs > period:
+            self.overruns += 1
+
+    def as_dict(self):
+        return {
+            'cycles': self.cycles, 'overruns': self.overruns, 'lastCycleMs': self.lastCycleMs,
+            'maxCycleMs': self.maxCycleMs, 'lastSuccess': self.lastSuccess, 'timeouts': self.timeouts,
+            'restarts': self.restarts, 'bucketsMs': list(self.BUCKETS),
+            'commands': {command: dict(stats, histogram=list(stats['histogram'])) for command, stats in list(self.commands.items())},
+        }
+
+# Every inverter handled by this process, keyed by USB path
+inverters = {}
+
+INVERTERD_PATH = '/data/etc/dbus-mppsolar/inverterd'
+
+class InverterdSupervisor(object):
+    """
+    Runs the inverterd instance of one inverter and keeps it healthy.
+    The child is watched from the GLib main loop, its output goes to our own
+    log (multilog), and readiness is probed with a cheap command rather than
+    fixed sleeps. Restarts never block the caller, back off exponentially
+    while inverterd keeps failing and are rate limited. A replacement is
+    only started once the previous instance was reaped, as both would need
+    the same port and device.
+    """
+    PROBE_COMMAND = 'get-protocol-id'
+    PROBE_INTERVAL = 0.2    # s between readiness probes
+    PROBE_TIMEOUT = 20      # s before a start that never got ready is retried
+    BACKOFF = (1, 60)       # s, first and longest delay before a restart
+    MAX_RESTARTS = 5        # restarts allowed within RESTART_WINDOW
+    RESTART_WINDOW = 600    # s
+    KILL_DELAY = 2000       # ms between SIGTERM and SIGKILL
+
+    def __init__(self, inverter, delay=1000):
+        self.inverter = inverter
+        self.delay = delay
+        self.process = None
+        self.ready = threading.Event()
+        self.readySince = None
+        self.on_ready = []
+        self._failures = 0
+        self._restarts = collections.deque()
+        self._pending = False
+        self._stopping = False
+        self._dying = None      # terminated instance not reaped yet
+        self._waiting = False   # restart due, held until it is
+        self._lock = threading.Lock()
+
+    def _spawn(self):
+        if self.inverter.transport is not None:
+            # Native P18 backend: nothing to run, only the probe
+            return None
+        import subprocess
+        # stdout/stderr inherited: inverterd logs end up in our multilog and can never fill a pipe
+        return subprocess.Popen(
+            [INVERTERD_PATH, '--usb-path', self.inverter.usb_path, '--port', str(self.inverter.port), '--delay', str(self.delay)],
+            stdin=subprocess.DEVNULL
+        )
+
+    def start(self):
+        self._stopping = False
+        self.ready.clear()
+        self.process = self._spawn()
+        if self.process is not None:
+            GLib.child_watch_add(GLib.PRIORITY_DEFAULT, self.process.pid, self._exited, self.process)
+        threading.Thread(target=self._probe, args=(self.process,), name=f'probe-{self.inverter.port}', daemon=True).start()
+        return self.process
+
+    def _probe(self, process):
+        started = time.monotonic()
+        while not self._stopping and process is self.process:
+            try:
+                safe_runInverterCommands(self.inverter, self.PROBE_COMMAND, (), 2)
+            except Exception:
+                if time.monotonic() - started > self.PROBE_TIMEOUT:
+                    logging.warning(f"inverterd on {self.inverter.usb_path} not ready after {self.PROBE_TIMEOUT} s, restarting")
+                    self.restart()
+                    return
+                time.sleep(self.PROBE_INTERVAL)
+                continue
+
+            self._failures = 0
+            self.readySince = time.time()
+            self.ready.set()
+            logging.info(f"inverterd on {self.inverter.usb_path} ready after {time.monotonic() - started:.1f} s")
+            for callback in self.on_ready:
+                GLib.idle_add(callback)
+            return
+
+    def _exited(self, pid, status, process):
+        # The child was reaped by GLib
+        if process is self._dying:
+            self._dying = None
+            if self._waiting:
+                self._waiting = False
+                self._start_again()
+            return
+        if process is not self.process or self._stopping:
+            return
+        logging.warning(f"inverterd on {self.inverter.usb_path} exited (status {status})")
+        self.process = None
+        self.ready.clear()
+        self.restart()
+
+    def restart(self):
+        """Restart inverterd after the backoff delay. Returns at once, from any thread."""
+        with self._lock:
+            if self._pending or self._stopping:
+                return
+            self._pending = True
+        self.ready.clear()
+        GLib.idle_add(self._restart)
+
+    def _restart(self):
+        process, self.process = self.process, None
+        if process is not None:
+            self._terminate(process)
+
+        now = time.monotonic()
+        while self._restarts and now - self._restarts[0] > self.RESTART_WINDOW:
+            self._restarts.popleft()
+        delay = min(self.BACKOFF[1], self.BACKOFF[0] * 2 ** self._failures)
+        if len(self._restarts) >= self.MAX_RESTARTS:
+            # Rate limited, wait until the oldest restart leaves the window
+            delay = max(delay, self.RESTART_WINDOW - (now - self._restarts[0]))
+        self._failures += 1
+
+        logging.warning(f"Restarting inverterd on {self.inverter.usb_path} in {delay:.0f} s")
+        GLib.timeout_add(int(delay * 1000), self._start_again)
+        return False
+
+    def _terminate(self, process):
+        # Reaped by its child watch, which starts a pending restart
+        self._dying = process
         process.terminate()
-        try:
-            process.wait(timeout=5)
-        except subprocess.TimeoutExpired:
+        GLib.timeout_add(self.KILL_DELAY, self._kill, process)
+
+    def _kill(self, process):
+        if process is self._dying:
             process.kill()
+        return False
+
+    def _start_again(self):
+        if self._dying is not None:
+            # The old instance still holds the port, go on once it is reaped
+            self._waiting = True
+            return False
+        self._restarts.append(time.monotonic())
+        self.inverter.stats.restarts += 1
+        with self._lock:
+            self._pending = False
+        if not self._stopping:
+            self.start()
+        return False
+
+    def stop(self, wait=True):
+        """
+        Stop inverterd. From the running main loop pass wait=False, the
+        child watch then reaps it; at exit the loop is gone, so wait for it.
+        """
+        self._stopping = True
+        self.ready.clear()
+        process, self.process = self.process, None
+        if not wait:
+            if process:
+                self._terminate(process)
+            return
+        import subprocess
+        # An instance terminated for a restart may not be reaped yet either
+        for process in (process, self._dying):
+            if process:
+                process.terminate()
+                try:
+                    process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        self._dying = None
+
+def start_inverterd(inverter):
+    inverters[inverter.usb_path] = inverter
+    return inverter.supervisor.start()
+
+def stop_inverterd(inverter=None):
+    for inv in ([inverter] if inverter else list(inverters.values())):
+        inv.supervisor.stop()
+
+class InverterdClient(Client):
+    """
+    inverterd client whose reads fail on a closed socket and honour a deadline.
+    The upstream client loops forever on an empty recv(), which would hang a
+    long-lived session as soon as inverterd goes away.
+    """
+    deadline = None
+
+    def _settimeout(self):
+        if self.deadline is None:
+            self.sock.settimeout(None)
+            return
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('inverterd deadline exceeded')
+        self.sock.settimeout(remaining)
+
+    def connect(self):
+        self._settimeout()
+        super().connect()
+
+    def _write(self, line):
+        self._settimeout()
+        super()._write(line)
+
+    def _read(self):
+        buf = bytearray()
+        while b'\r\n\r\n' not in buf:
+            self._settimeout()
+            chunk = self.sock.recv(256)
+            if not chunk:
+                raise ConnectionResetError('inverterd closed the connection')
+            buf.extend(chunk)
+
+        response = buf.decode().strip().split("\r\n")
+        status = response.pop(0)
+        if status not in ('ok', 'err'):
+            raise InverterError(f"Unexpected status '{status}'")
+        if status == 'err':
+            raise InverterError(response[0] if response else "Unknown error")
+
+        return '\r\n'.join(response)
+
+class InverterdBusy(RuntimeError):
+    """A command was dropped before being sent because inverterd was busy."""
+
+class InverterNotConnected(RuntimeError):
+    """The tty of a service is not in the config or not plugged in."""
+
+class InverterdConnection(object):
+    """
+    Long-lived session with one inverterd instance.
+    The output format is negotiated once per socket and the session is reused
+    for every command. A socket error drops the session and the command is
+    retried once on a fresh one.
+
+    Every command has a deadline enforced at the socket level. A command that
+    misses it is abandoned: queued ones are never sent, a running one has its
+    session dropped so a late answer cannot be mistaken for the next one.
+    At most max_inflight callers may be queued or running at once.
+    """
+    def __init__(self, port, host='127.0.0.1', fmt=Format.JSON, max_inflight=2):
+        self.port = port
+        self.host = host
+        self.format = fmt
+        self._client = None
+        self._lock = threading.Lock()
+        self._inflight = threading.BoundedSemaphore(max_inflight)
+
+        # Counters
+        self.connects = 0
+        self.reuses = 0
+        self.reconnects = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    def _open(self, deadline):
+        client = InverterdClient(self.port, self.host)
+        client.deadline = deadline
+        try:
+            client.connect()
+            client.format(self.format)
+        except:
+            client.sock.close()
+            raise
+        self._client = client
+        self.connects += 1
+
+    def close(self):
+        # Not locked on purpose: this is used to abort a session that is stuck
+        # in a read from another thread, shutdown() wakes it up.
+        client, self._client = self._client, None
+        if client:
+            try:
+                client.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.sock.close()
+
+    def exec(self, command: str, params: tuple = (), timeout: float = None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        if not self._inflight.acquire(blocking=False):
+            self.rejected += 1
+            raise InverterdBusy(f"too many pending inverterd commands on port {self.port}, '{command}' dropped")
+        try:
+            if not self._lock.acquire(timeout=timeout if timeout is not None else -1):
+                self.cancelled += 1
+                raise InverterdBusy(f"'{command}' cancelled, inverterd on port {self.port} is busy")
+            try:
+                return self._exec(command, params, deadline)
+            except TimeoutError:
+                self.timeouts += 1
+                self.close()
+                raise
+            finally:
+                self._lock.release()
+        finally:
+            self._inflight.release()
+
+    def _exec(self, command, params, deadline):
+        if self._client is None:
+            self._open(deadline)
+        else:
+            self.reuses += 1
+            self._client.deadline = deadline
+        try:
+            return self._client.exec(command, params)
+        except TimeoutError:
+            raise
+        except OSError as e:
+            logging.info(f"inverterd session on port {self.port} lost ({e}), reconnecting")
+            self.close()
+            self.reconnects += 1
+            self._open(deadline)
+            return self._client.exec(command, params)
+
+    def stats(self):
+        return {'connects': self.connects, 'reuses': self.reuses, 'reconnects': self.reconnects,
+                'timeouts': self.timeouts, 'cancelled': self.cancelled, 'rejected': self.rejected}
+
+# One connection per inverterd instance, keyed by (host, port)
+inverterd_connections = {}
+
+def get_inverterd_connection(port, host='127.0.0.1', fmt=None):
+    key = (host, port)
+    if key not in inverterd_connections:
+        inverterd_connections[key] = InverterdConnection(port, host, fmt or output_format)
+    return inverterd_connections[key]
+
+def close_inverterd_connection(port, host='127.0.0.1'):
+    connection = inverterd_connections.get((host, port))
+    if connection:
+        connection.close()
+
+def _crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1
+        table.append(crc & 0xFFFF)
+    return table
+
+P18_CRC_TABLE = _crc_table()
+
+def p18_crc(data):
+    # CRC-16/XMODEM, bytes that would read as '(', CR or LF are bumped by one
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ P18_CRC_TABLE[(crc >> 8) ^ byte]
+    high, low = crc >> 8, crc & 0xFF
+    if high in (0x28, 0x0d, 0x0a):
+        high += 1
+    if low in (0x28, 0x0d, 0x0a):
+        low += 1
+    return high << 8 | low
+
+def p18_frame(kind, body):
+    # ^<kind><length><body><crc>\r, the length counts the body, the CRC and the CR
+    frame = f'^{kind}{len(body) + 3:03d}{body}'.encode('ascii')
+    crc = p18_crc(frame)
+    return frame + bytes((crc >> 8, crc & 0xFF)) + b'\r'
+
+def p18_fields(layout, record=None):
+    # Parser of a comma separated answer: (name, scale or enum labels) per field,
+    # 1 for a plain integer, None for a boolean flag. Fills a dict, or an
+    # instance of `record` when given.
+    def parse(data):
+        values = record() if record else {}
+        store = values.__setattr__ if record else values.__setitem__
+        for (name, kind), raw in zip(layout, data.split(',')):
+            if kind is None:
+                store(name, raw == '1')
+            elif isinstance(kind, tuple):
+                number = int(raw)
+                store(name, kind[number] if number < len(kind) else number)
+            elif kind == 1:
+                store(name, int(raw))
+            else:
+                store(name, round(int(raw) * kind, 1))
+        return values
+    return parse
+
+P18_MPPT_STATUS = ('Abnormal', 'Not charging', 'Charging')
+P18_DIRECTIONS = ('Do nothing', 'Charge', 'Discharge')
+P18_STATUS_LAYOUT = (
+    ('grid_voltage', 0.1), ('grid_freq', 0.1), ('ac_output_voltage', 0.1), ('ac_output_freq', 0.1),
+    ('ac_output_apparent_power', 1), ('ac_output_active_power', 1), ('output_load_percent', 1),
+    ('battery_voltage', 0.1), ('battery_voltage_scc', 0.1), ('battery_voltage_scc2', 0.1),
+    ('battery_discharge_current', 1), ('battery_charge_current', 1), ('battery_capacity', 1),
+    ('inverter_heat_sink_temp', 1), ('mppt1_charger_temperature', 1), ('mppt2_charger_temperature', 1),
+    ('pv1_input_power', 1), ('pv2_input_power', 1), ('pv1_input_voltage', 0.1), ('pv2_input_voltage', 0.1),
+    ('settings_values_changed', None), ('mppt1_charger_status', P18_MPPT_STATUS), ('mppt2_charger_status', P18_MPPT_STATUS),
+    ('load_connected', ('Disconnected', 'Connected')), ('battery_power_direction', P18_DIRECTIONS),
+    ('dc_ac_power_direction', ('Do nothing', 'AC/DC', 'DC/AC')), ('line_power_direction', ('Do nothing', 'Input', 'Output')),
+    ('local_parallel_id', 1),
+)
+
+class StatusRecord(object):
+    """
+    get-status as a flat record with one typed slot per field, filled
+    straight from the wire without intermediate dicts. Reads like the dict
+    of flatten_fields(): get() returns None for a field that was not sent.
+    """
+    __slots__ = tuple(name for name, _ in P18_STATUS_LAYOUT)
+    TYPES = {name: bool if kind is None else str if isinstance(kind, tuple) else int if kind == 1 else float
+             for name, kind in P18_STATUS_LAYOUT}
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def items(self):
+        for name in self.__slots__:
+            if hasattr(self, name):
+                yield name, getattr(self, name)
+
+P18_STATUS = p18_fields(P18_STATUS_LAYOUT, StatusRecord)
+P18_RATED = p18_fields((
+    ('ac_input_rating_voltage', 0.1), ('ac_input_rating_current', 0.1), ('ac_output_rating_voltage', 0.1),
+    ('ac_output_rating_freq', 0.1), ('ac_output_rating_current', 0.1), ('ac_output_rating_apparent_power', 1),
+    ('ac_output_rating_active_power', 1), ('battery_rating_voltage', 0.1), ('battery_recharge_voltage', 0.1),
+    ('battery_redischarge_voltage', 0.1), ('battery_under_voltage', 0.1), ('battery_bulk_voltage', 0.1),
+    ('battery_float_voltage', 0.1), ('battery_type', ('AGM', 'Flooded', 'User')), ('max_ac_charging_current', 1),
+    ('max_charging_current', 1), ('input_voltage_range', ('Appliance', 'UPS')),
+    ('output_source_priority', ('Solar-Utility-Battery', 'Solar-Battery-Utility')),
+    ('charger_source_priority', ('Solar-First', 'Solar-and-Utility', 'Solar-Only')), ('parallel_max_num', 1),
+    ('machine_type', ('Off-Grid-Tie', 'Grid-Tie')), ('topology', ('Transformerless', 'Transformer')),
+    ('output_model_setting', 1), ('solar_power_priority', ('Battery-Load-Utility', 'Load-Battery-Utility')),
+    ('mppt_string', 1),
+))
+P18_ERRORS = p18_fields((('fault_code', 1),) + tuple((name, None) for name in (
+    'line_fail', 'output_circuit_short', 'inverter_over_temperature', 'fan_lock', 'battery_voltage_high',
+    'battery_low', 'battery_under', 'over_load', 'eeprom_fail', 'power_limit', 'pv1_voltage_high',
+    'pv2_voltage_high', 'mppt1_overload_warning', 'mppt2_overload_warning',
+    'battery_too_low_to_charge_for_scc1', 'battery_too_low_to_charge_for_scc2')))
+P18_MODES = ('Power on mode', 'Standby mode', 'Bypass mode', 'Battery mode', 'Fault mode', 'Hybrid mode')
+
+def _p18_serial(data):
+    # Length of the serial number, then the number padded with zeros
+    return {'serial': data[2:2 + int(data[:2])]}
+
+def _p18_cpu(data):
+    main, slave1, slave2 = (data.split(',') + ['', ''])[:3]
+    return {'main_cpu_version': main, 'slave1_cpu_version': slave1, 'slave2_cpu_version': slave2}
+
+# inverterd command -> (frame kind, body builder, answer parser). Answers have
+# the shape of inverterd's JSON data, for the commands used by this service.
+P18_COMMANDS = {
+    'get-protocol-id': ('P', lambda: 'PI', lambda data: {'id': int(data)}),
+    'get-serial-number': ('P', lambda: 'ID', _p18_serial),
+    'get-cpu-version': ('P', lambda: 'VFW', _p18_cpu),
+    'get-total-generated': ('P', lambda: 'ET', lambda data: {'wh': int(data)}),
+    'get-day-generated': ('P', lambda year, month, day: f'ED{int(year):04d}{int(month):02d}{int(day):02d}', lambda data: {'wh': int(data)}),
+    'get-status': ('P', lambda: 'GS', P18_STATUS),
+    'get-mode': ('P', lambda: 'MOD', lambda data: {'mode': P18_MODES[int(data)] if int(data) < len(P18_MODES) else int(data)}),
+    'get-rated': ('P', lambda: 'PIRI', P18_RATED),
+    'get-errors': ('P', lambda: 'FWS', P18_ERRORS),
+    'set-max-charge-voltage': ('S', lambda bulk, floating: f'MCHGV{round(float(bulk) * 10):03d},{round(float(floating) * 10):03d}', None),
+    'set-max-charge-current': ('S', lambda id, amps: f'MCHGC{int(id)},{int(amps):03d}', None),
+    'set-max-ac-charge-current': ('S', lambda id, amps: f'MUCHGC{int(id)},{int(amps):03d}', None),
+    'set-output-source-priority': ('S', lambda priority: f'POP{int(priority)}', None),
+    # Parallel id 0 when only the priority is given
+    'set-charge-source-priority': ('S', lambda *args: 'PCP{},{}'.format(*((0,) + args)[-2:]), None),
+}
+
+class P18Transport(object):
+    """
+    P18 spoken directly to /dev/hidrawX, in place of an inverterd instance,
+    with the same exec() as InverterdConnection. Frames go out as 8 byte HID
+    reports and answers are read with poll() on the non-blocking device into
+    a preallocated buffer, then checked (header, length, CRC) before being
+    parsed. GLib watches the device so an unplugged inverter is reopened on
+    the next command, the descriptor itself is only ever closed by the
+    thread running the commands. Commands are `delay` ms apart.
+    """
+    REPORT = 8
+    HUP = GLib.IO_HUP | GLib.IO_ERR
+
+    def __init__(self, usb_path, delay=100):
+        self.usb_path = usb_path
+        self.delay = delay
+        self._fd = None
+        self._poll = None
+        self._watch = None
+        self._gone = False
+        self._hup = 0
+        self._buffer = bytearray(256)
+        self._view = memoryview(self._buffer)
+        self._lock = threading.Lock()
+        self._last = 0.0
+
+        # Counters
+        self.opens = 0
+        self.commands = 0
+        self.timeouts = 0
+        self.crcErrors = 0
+
+    def _open(self):
+        import select
+        self._fd = os.open(self.usb_path, os.O_RDWR | os.O_NONBLOCK)
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLIN)
+        self._hup = select.POLLHUP | select.POLLERR | select.POLLNVAL
+        self._watch = GLib.io_add_watch(self._fd, GLib.PRIORITY_DEFAULT, self.HUP, self._hangup)
+        self.opens += 1
+
+    def _hangup(self, fd, condition):
+        # A command may be using the descriptor, the next one closes it
+        logging.warning(f"{self.usb_path} went away")
+        self._watch = None
+        self._gone = True
+        return False
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        fd, self._fd = self._fd, None
+        self._gone = False
+        if self._watch is not None:
+            GLib.source_remove(self._watch)
+            self._watch = None
+        if fd is not None:
+            os.close(fd)
+
+    def exec(self, command: str, params: tuple = (), timeout: float = None):
+        if command not in P18_COMMANDS:
+            raise InverterError(f"'{command}' is not supported by the P18 backend")
+        kind, body, parse = P18_COMMANDS[command]
+        frame = p18_frame(kind, body(*params))
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        if not self._lock.acquire(timeout=timeout if timeout is not None else -1):
+            raise InverterdBusy(f"'{command}' cancelled, {self.usb_path} is busy")
+        try:
+            if self._gone:
+                self._close()
+            if self._fd is None:
+                self._open()
+            pause = self._last + self.delay / 1000 - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            self._drain()
+            for start in range(0, len(frame), self.REPORT):
+                os.write(self._fd, frame[start:start + self.REPORT])
+            length = self._read_frame(deadline)
+            self._last = time.monotonic()
+            self.commands += 1
+            data = self._check(length)
+        except TimeoutError:
+            self.timeouts += 1
+            self._close()
+            raise
+        except OSError:
+            self._close()
+            raise
+        finally:
+            self._lock.release()
+
+        if parse is None:
+            return {'result': 'ok'}
+        return {'result': 'ok', 'data': parse(data)}
+
+    def _drain(self):
+        # A late answer to an abandoned command must not be taken for this one
+        try:
+            while os.readv(self._fd, [self._view]):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _read_frame(self, deadline):
+        size = 0
+        while True:
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError(f'no answer from {self.usb_path}')
+            events = self._poll.poll(None if remaining is None else remaining * 1000)
+            if not events:
+                continue
+            if events[0][1] & self._hup:
+                raise ConnectionResetError(f'{self.usb_path} went away')
+            try:
+                count = os.readv(self._fd, [self._view[size:]])
+            except BlockingIOError:
+                continue
+            if not count:
+                raise ConnectionResetError(f'{self.usb_path} closed')
+            # Reports are padded with NULs after the CR
+            end = self._buffer.find(b'\r', size, size + count)
+            if end >= 0:
+                return end + 1
+            size += count
+            if size >= len(self._buffer):
+                raise InverterError(f'unterminated answer from {self.usb_path}')
+
+    def _check(self, length):
+        # ^D<length><data><crc>\r for a query, ^1<crc>\r or ^0<crc>\r for a setting
+        view = self._view
+        if length < 5 or view[0] != 0x5e:
+            raise InverterError(f'malformed answer from {self.usb_path}')
+        if p18_crc(view[:length - 3]) != view[length - 3] << 8 | view[length - 2]:
+            self.crcErrors += 1
+            raise InverterError(f'CRC error in the answer from {self.usb_path}')
+        kind = view[1]
+        if kind == 0x31:    # 1
+            return None
+        if kind == 0x30:    # 0
+            raise InverterError('refused by the inverter')
+        if kind != 0x44 or int(bytes(view[2:5])) != length - 5:
+            raise InverterError(f'malformed answer from {self.usb_path}')
+        return bytes(view[5:length - 3]).decode('ascii')
+
+    def stats(self):
+        return {'opens': self.opens, 'commands': self.commands, 'timeouts': self.timeouts, 'crcErrors': self.crcErrors}
+
+# Units of inverterd's table formats, anything else after a value is part of a text
+TABLE_UNITS = frozenset(('V', 'A', 'Hz', 'W', 'VA', '%', '°C', 'Wh', 'kWh'))
+
+# Text after the key -> typed value, per StatusRecord field type
+TABLE_CONVERTERS = {
+    float: lambda text: float(text.split(' ', 1)[0]),
+    int: lambda text: int(text.split(' ', 1)[0]),
+    bool: lambda text: text in ('true', '1', 'yes'),
+    str: lambda text: text.strip('"'),
+}
+
+def _table_value(text):
+    token, _, rest = text.partition(' ')
+    # Untyped field: a number with an optional unit, true/false, or a text
+    if rest and rest not in TABLE_UNITS:
+        return text.strip('"')
+    if token in ('true', 'false'):
+        return token == 'true'
+    try:
+        return float(token) if '.' in token else int(token)
+    except ValueError:
+        return text.strip('"')
+
+STATUS_CONVERTERS = {name: TABLE_CONVERTERS[kind] for name, kind in StatusRecord.TYPES.items()}
+# Typed fields of the other commands, the rest goes through _table_value.
+# Identification looks numeric but keeps its leading zeros, as in JSON.
+COMMAND_CONVERTERS = {
+    'get-protocol-id': {'id': TABLE_CONVERTERS[int]},
+    'get-serial-number': {'serial': TABLE_CONVERTERS[str]},
+    'get-cpu-version': {name: TABLE_CONVERTERS[str] for name in ('main_cpu_version', 'slave1_cpu_version', 'slave2_cpu_version')},
+}
+
+def parse_simple_table(command, output):
+    """
+    Parse inverterd's simple-table output, one "key value [unit]" per line.
+    get-status goes straight into a StatusRecord, other commands into the
+    flat dict flatten_fields() would have made of their JSON.
+    """
+    if command == 'get-status':
+        record = StatusRecord()
+        converters = STATUS_CONVERTERS
+        for line in output.splitlines():
+            key, _, text = line.partition(' ')
+            convert = converters.get(key)
+            if convert is not None:
+                setattr(record, key, convert(text))
+        return record
+    data = {}
+    converters = COMMAND_CONVERTERS.get(command, {})
+    for line in output.splitlines():
+        key, _, text = line.partition(' ')
+        if key:
+            data[key] = converters.get(key, _table_value)(text)
+    return {'result': 'ok', 'data': data}
+
+def get_connection(inverter):
+    # The link commands go through: native P18 or the inverterd session
+    return inverter.transport or get_inverterd_connection(inverter.port, inverter.host, inverter.format)
+
+def close_connection(inverter):
+    if inverter.transport is not None:
+        inverter.transport.close()
+    else:
+        close_inverterd_connection(inverter.port, inverter.host)
 
 # Inverter commands to read from the serial
-def safe_runInverterCommands(command: str, params: tuple = ()):
+def safe_runInverterCommands(inverter, command: str, params: tuple = (), timeout_sec: float = None):
     """
     Exécute une commande sur l'onduleur via la librairie inverterd.
+    La session avec inverterd est conservée entre les commandes.
 
+    :param inverter: L'onduleur (Inverter) à interroger
     :param command: La commande à exécuter (ex: 'get-status', 'get-year-generated')
     :param params: Tuple de paramètres à passer à la commande (ex: (2021,), (2021, 2022))
+    :param timeout_sec: Délai maximum en secondes, TimeoutError au-delà
     :return: Le résultat de la commande
     """
-    global args
-    global mainloop
-    global port
-    global host
-    global output_format
-
-    c = Client(port, host)
-    c.connect()
-    c.format(output_format)
-    
-    # Exécution avec ou sans paramètres selon que le tuple est vide ou non
-    if params:
-        output = c.exec(command, params)
+    connection = get_connection(inverter)
+    output = connection.exec(command, params, timeout_sec)
+
+    # The P18 backend answers already parsed
+    if not isinstance(output, str):
+        parsed = output
+    elif connection.format == Format.SIMPLE_TABLE:
+        parsed = parse_simple_table(command, output)
     else:
-        output = c.exec(command)
-
-    parsed = json.loads(output)
+        parsed = json.loads(output)
 
     return parsed
 
-def runInverterCommands(command: str, params: tuple = (), timeout_sec: int = 10):
+def runInverterCommands(inverter, command: str, params: tuple = (), timeout_sec: int = 10):
     """
     Exécute la commande inverter avec surveillance du timeout.
-    Si inverterd ne répond pas, il est redémarré automatiquement.
+    Si inverterd ne répond pas, son redémarrage est demandé au superviseur
+    et la commande échoue sans attendre : le prochain cycle la refera.
     """
-    global usb_path
+    if not inverter.supervisor.ready.is_set():
+        raise InverterdBusy(f"inverterd on {inverter.usb_path} is not ready, '{command}' not sent")
 
-    while True:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(safe_runInverterCommands, command, params)
+    started = time.monotonic()
+    try:
+        result = safe_runInverterCommands(inverter, command, params, timeout_sec)
+        inverter.stats.command_done(command, time.monotonic() - started, True)
+        return result
+    except TimeoutError:
+        inverter.stats.command_done(command, time.monotonic() - started, False)
+        inverter.stats.timeouts += 1
+        logging.warning(f"[ERROR] inverterd on {inverter.usb_path} is not responding to '{command}', restarting...")
+        close_connection(inverter)
+        inverter.supervisor.restart()
+        raise
+    except:
+        inverter.stats.command_done(command, time.monotonic() - started, False)
+        raise
+
+class CommandQueue(object):
+    """
+    The single line to one inverter. Every command goes through this queue
+    and is run by its worker thread, control writes first, then BMS
+    setpoints, then reads, in submission order within a priority. The poll
+    waits for its reads on its own worker (asyncPoll, the default), so a
+    write waits for at most the command in progress, not for a poll cycle.
+    A read submitted while the same one is still waiting shares its result.
+    """
+    WRITE, SETPOINT, READ = range(3)
+
+    def __init__(self, inverter):
+        self.inverter = inverter
+        self._heap = []
+        self._reads = {}    # (command, params) -> future of a waiting read
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+        # Counters
+        self.executed = 0
+        self.coalesced = 0
+        self.preempted = 0
+
+    def submit(self, command, params=(), priority=READ, timeout_sec=10):
+        """Queue a command, returns a concurrent.futures.Future of its result."""
+        params = tuple(params)
+        with self._cond:
+            if priority == self.READ:
+                future = self._reads.get((command, params))
+                if future is not None:
+                    self.coalesced += 1
+                    return future
+            future = concurrent.futures.Future()
+            if priority == self.READ:
+                self._reads[(command, params)] = future
+            elif any(entry[0] == self.READ for entry in self._heap):
+                self.preempted += 1
+            heapq.heappush(self._heap, (priority, next(self._order), command, params, timeout_sec, future))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name=f'queue-{self.inverter.port}', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def run(self, command, params=(), priority=READ, timeout_sec=10):
+        """Queue a command and wait for its result."""
+        return self.submit(command, params, priority, timeout_sec).result()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                priority, _, command, params, timeout_sec, future = heapq.heappop(self._heap)
+                if priority == self.READ:
+                    self._reads.pop((command, params), None)
+            if not future.set_running_or_notify_cancel():
+                continue
             try:
-                return future.result(timeout=timeout_sec)
-            except concurrent.futures.TimeoutError:
-                logging.warning(f"[ERROR] inverterd is not responding to '{command}', restarting...")
-                stop_inverterd()
-                time.sleep(3)
-                start_inverterd(usb_path)
-                time.sleep(3)  # Laisse un peu de temps au process pour redémarrer
+                future.set_result(runInverterCommands(self.inverter, command, params, timeout_sec))
+            except Exception as e:
+                future.set_exception(e)
+            self.executed += 1
 
-def find_battery_service():
-    bus = dbus.SystemBus()
-    om = bus.get_object('org.freedesktop.DBus', '/org/freedesktop/DBus')
-    iface = dbus.Interface(om, 'org.freedesktop.DBus')
-    names = iface.ListNames()
+    def stats(self):
+        return {'executed': self.executed, 'coalesced': self.coalesced, 'preempted': self.preempted,
+                'waiting': len(self._heap)}
+
+class BatteryServiceMonitor(object):
+    """
+    Tracks the com.victronenergy.battery.* services on the bus.
+    The bus is listed once, then kept in sync with NameOwnerChanged. The
+    charge limits of the selected battery are imported once and kept up to
+    date by their PropertiesChanged signals, so reading them costs nothing.
+    """
+    PREFIX = 'com.victronenergy.battery.'
+    PATHS = ('/Info/MaxChargeVoltage', '/Info/MaxChargeCurrent')
+
+    def __init__(self, bus):
+        self._bus = bus
+        self._services = set()
+        self._imports = {}
+        self._values = {}
+        self.service = None
+
+        bus.add_signal_receiver(self._name_owner_changed, signal_name='NameOwnerChanged',
+                                dbus_interface='org.freedesktop.DBus')
+        om = bus.get_object('org.freedesktop.DBus', '/org/freedesktop/DBus')
+        for name in dbus.Interface(om, 'org.freedesktop.DBus').ListNames():
+            if name.startswith(self.PREFIX):
+                self._services.add(str(name))
+        self._select()
+
+    def _name_owner_changed(self, name, old_owner, new_owner):
+        if not name.startswith(self.PREFIX):
+            return
+        if new_owner:
+            self._services.add(str(name))
+        else:
+            self._services.discard(str(name))
+        self._select()
+
+    def _select(self):
+        service = min(self._services) if self._services else None
+        if service == self.service:
+            return
+
+        for item in self._imports.values():
+            match = getattr(item, '_match', None)
+            if match is not None:
+                match.remove()
+        self._imports = {}
+        self._values = {}
+
+        self.service = service
+        logging.info(f"Battery service: {service}")
+        if service:
+            for path in self.PATHS:
+                self._imports[path] = VeDbusItemImport(self._bus, service, path, eventCallback=self._value_changed)
+                self._values[path] = self._valid(self._imports[path].get_value())
+
+    @staticmethod
+    def _valid(value):
+        # An invalid item has an empty array as value
+        if isinstance(value, dbus.Array) and not value:
+            return None
+        return value
+
+    def _value_changed(self, service, path, changes):
+        if service == self.service:
+            self._values[path] = self._valid(changes.get('Value'))
+
+    def get_value(self, path):
+        return self._values.get(path)
+
+# Shared connection for everything this process reads from the bus
+shared_bus = None
+shared_bus_exported = False
+battery_monitor = None
+
+def get_bus():
+    global shared_bus
+    if shared_bus is None:
+        shared_bus = dbusconnection()
+    return shared_bus
+
+def get_service_bus():
+    """
+    Connection for one exported service. Services all export '/', so each
+    needs a connection of its own, the first one reuses the shared one.
+    """
+    global shared_bus_exported
+    if not shared_bus_exported:
+        shared_bus_exported = True
+        return get_bus()
+    return dbusconnection()
+
+def get_battery_monitor():
+    global battery_monitor
+    if battery_monitor is None:
+        battery_monitor = BatteryServiceMonitor(get_bus())
+    return battery_monitor
 
-    for name in names:
-        if name.startswith('com.victronenergy.battery.'):
-            return name
-    return None
+def find_battery_service():
+    return get_battery_monitor().service
 
-def setOutputSource(source):
+class SetpointCache(object):
+    """
+    Last value acknowledged by the inverter for each setpoint command.
+    A setpoint is only written again when one of its rounded parameters moved
+    by more than `deadband`, or as a keep-alive once `refresh` seconds passed
+    since the last acknowledgement.
+    """
+    def __init__(self, inverter, deadband=0, refresh=300):
+        self.inverter = inverter
+        self.deadband = deadband
+        self.refresh = refresh
+        self._acked = {}
+
+        # Counters
+        self.sent = 0
+        self.skipped = 0
+
+    def _changed(self, last, params):
+        if len(last) != len(params):
+            return True
+        for old, new in zip(last, params):
+            if isinstance(old, (int, float)) and isinstance(new, (int, float)):
+                if abs(new - old) > self.deadband:
+                    return True
+            elif old != new:
+                return True
+        return False
+
+    def needs_write(self, key, params: tuple):
+        acked = self._acked.get(key)
+        if acked is None:
+            return True
+        last, when = acked
+        if self.refresh and time.monotonic() - when >= self.refresh:
+            return True
+        return self._changed(last, params)
+
+    def send(self, command: str, params: tuple, key=None):
+        # Setpoints addressed to different targets (e.g. parallel ids) need their own key
+        key = key if key is not None else command
+        if not self.needs_write(key, params):
+            self.skipped += 1
+            logging.debug(f"'{command} {params}' already applied, skipped")
+            return None
+        result = self.inverter.queue.run(command, params, CommandQueue.SETPOINT)
+        self._acked[key] = (params, time.monotonic())
+        self.sent += 1
+        return result
+
+    def forget(self, key=None):
+        if key is None:
+            self._acked.clear()
+        else:
+            self._acked.pop(key, None)
+
+    def stats(self):
+        return {'sent': self.sent, 'skipped': self.skipped}
+
+def setOutputSource(inverter, source):
     #POP<NN>: Setting device output source priority
     #    NN = 00 for utility first, 01 for solar first, 02 for SBU priority
     #   For PI18, Output POP0 [0: Solar-Utility-Batter],  POP1 [1: Solar-Battery-Utility]
-    return runInverterCommands('set-output-source-priority', (source,))
+    # Returns the future of the queued write
+    return inverter.queue.submit('set-output-source-priority', (source,), CommandQueue.WRITE)
 
-def setChargerPriority(priority):
+def setChargerPriority(inverter, priority):
     #PCP<NN>: Setting device charger priority
     #  For KS: 00 for utility first, 01 for solar first, 02 for solar and utility, 03 for only solar charging
     #  For MKS: 00 for utility first, 01 for solar first, 03 for only solar charging
     #   For PI18, 0: Solar first, 1: Solar and Utility, 2: Only solar
-    return runInverterCommands('set-charge-source-priority', (priority,))
+    # Returns the future of the queued write
+    return inverter.queue.submit('set-charge-source-priority', (priority,), CommandQueue.WRITE)
 
-def setMaxChargingVoltage(bulk, float):
+def setMaxChargingVoltage(inverter, bulk, float):
     #MCHGV : Setting bulk and float voltage
     # For PI18 : MCHGV552,540 will set Bulk - CV voltage [480~584] in 0.1V xxx, Float voltage [480~584] in 0.1V
    try:
-    return runInverterCommands('set-max-charge-voltage', (round(bulk, 1), round(float, 1)))
+    return inverter.setpoints.send('set-max-charge-voltage', (round(bulk, 1), round(float, 1)))
    except:
     logging.warning("Fail to set max charging voltage to {} and {}".format(bulk, float), exc_info=True)
     return True
 
-def setMaxChargingCurrent(id, current):
+def setMaxChargingCurrent(inverter, id, current, chargers=None):
     #MNCHGC<mnnn><cr>: Setting max charging current (More than 100A)
     #  Setting value can be gain by QMCHGCR command.
     #  nnn is max charging current, m is parallel number.
+    #  chargers defaults to the configured numberOfChargers, 1 when current already is this inverter's share.
     try:
-        roundedCurrent = min(max (0, round(current / 10 / numberOfChargers) * 10), 80)
-        return runInverterCommands('set-max-charge-current', (id, roundedCurrent,))
+        roundedCurrent = min(max (0, round(current / 10 / (chargers or inverter.numberOfChargers)) * 10), 80)
+        return inverter.setpoints.send('set-max-charge-current', (id, roundedCurrent,), key=('set-max-charge-current', id))
     except:
-        logging.warning("Fail to set max charging current to {:d}".format(current))
+        logging.warning("Fail to set max charging current to {}".format(current))
         return True
     
-def setMaxUtilityChargingCurrent(id, current):
+def setMaxUtilityChargingCurrent(inverter, id, current):
     #MUCHGC<nnn><cr>: Setting utility max charging current
     #  Setting value can be gain by QMCHGCR command.
     #  nnn is max charging current, m is parallel number.
-    roundedCurrent = min(max(2, round(current / 10 / numberOfChargers) * 10), 80)
+    roundedCurrent = min(max(2, round(current / 10 / inverter.numberOfChargers) * 10), 80)
     try:
-       return runInverterCommands('set-max-ac-charge-current', (id, roundedCurrent,))
+       return inverter.setpoints.send('set-max-ac-charge-current', (id, roundedCurrent,), key=('set-max-ac-charge-current', id))
     except:
         logging.warning("Fail to set max charging current to {:d}".format(current))
         return True
 
+# /Mode value -> (name, charger source priority, output source priority)
+MODE_SETTINGS = {
+    1: ("'Charger Only'(Charger=Util)", 1, 1),
+    2: ("'Inverter Only'(Charger=Solar & Output=SBU)", 0, 2),
+    3: ("'ON=Charge+Invert'(Charger=Util & Output=SBU)", 1, 2),
+    4: ("'OFF'(Charger=Solar)", 3, 2),
+}
+
 def isNaN(num):
     return num != num
 
+# Commands read on every poll, with the name their result is published under
+POLL_COMMANDS = (
+    ('generated', 'get-total-generated'),
+    ('data', 'get-status'),
+    ('mode', 'get-mode'),
+    ('rated', 'get-rated'),
+    ('alerts', 'get-errors'),
+)
+POLL_RESULT_NAMES = {command: name for name, command in POLL_COMMANDS}
+
+# Commands with timings published under /Mgmt/Stats/Commands
+STATS_COMMANDS = tuple(command for _, command in POLL_COMMANDS) + (
+    'get-day-generated',
+    'set-max-charge-voltage',
+    'set-max-charge-current',
+    'set-max-ac-charge-current',
+    'set-output-source-priority',
+    'set-charge-source-priority',
+)
+# Their D-Bus path prefixes, built once rather than on every poll
+STATS_PREFIXES = {command: '/Mgmt/Stats/Commands/' + ''.join(word.capitalize() for word in command.split('-'))
+                  for command in STATS_COMMANDS}
+# Same for the counters groups, filled as they show up
+STATS_GROUP_PATHS = {}
+# Static identification, read once after the first successful poll
+STATIC_COMMANDS = (
+    ('serial', 'get-serial-number'),
+    ('cpu', 'get-cpu-version'),
+    ('protocol', 'get-protocol-id'),
+)
+# Refusals of one of them before it is taken as not supported
+STATIC_MAX_ERRORS = 5
+# (path, result, field, transform), published on both services
+STATIC_TABLE = (
+    ('/Serial', 'serial', 'serial', None),
+    ('/FirmwareVersion', 'cpu', 'main_cpu_version', None),
+    ('/HardwareVersion', 'protocol', 'id', lambda id: f'PI{id:02d}' if isinstance(id, int) else id),
+)
+# Not a Victron product
+PRODUCT_ID = 0xFFFF
+
+def flatten_fields(result, into=None):
+    # {'data': {field: {'value': x, 'unit': u} or x}} -> {field: x}, in one pass
+    # A StatusRecord is flat already. `into`, a dict, is refilled and returned
+    if isinstance(result, StatusRecord):
+        return result
+    data = result.get('data') if isinstance(result, dict) else None
+    if isinstance(data, StatusRecord):
+        return data
+    flat = into if isinstance(into, dict) else {}
+    flat.clear()
+    if data:
+        for key, value in data.items():
+            flat[key] = value.get('value') if isinstance(value, dict) else value
+    return flat
+
+# 0=Off;1=Low Power;2=Fault;9=Inverting
+INVERTER_STATES = {'Battery mode': 9, 'Fault mode': 2}
+
+def inverter_error_code(fault_code, over_temperature, over_load):
+    if fault_code == 0:
+        return None
+    code = None
+    if over_temperature:
+        code = 17
+    if over_load:
+        code = 18
+    return code
+
+def charger_error_code(fault_code, over_temperature, mppt_overload):
+    if fault_code == 0:
+        return None
+    code = None
+    if over_temperature:
+        code = 17
+    if mppt_overload:
+        code = 18
+    return code
+
+def yield_kwh(wh):
+    return wh / 1000 if wh else None
+
+# What gets published from the poll results, one row per D-Bus path:
+#   (service, path, result, fields, transform, reducer)
+# service is 'inverter' or 'charger', result one of the POLL_COMMANDS names and
+# fields the response field(s) passed to transform. A None value, from a
+# missing field or from transform, leaves the path untouched. A reducer
+# (max/min) publishes the extreme seen since start instead of the last value.
+PUBLISH_TABLE = (
+    ('inverter', '/State', 'mode', 'mode', lambda mode: INVERTER_STATES.get(mode, 0), None),
+    ('inverter', '/Dc/0/Voltage', 'data', 'battery_voltage', None, None),
+    ('inverter', '/Ac/Out/L1/V', 'data', 'ac_output_voltage', None, None),
+    ('inverter', '/Ac/Out/L1/P', 'data', 'ac_output_active_power', None, None),
+    ('inverter', '/Ac/Out/L1/I', 'data', ('ac_output_active_power', 'ac_output_voltage'), lambda p, v: p / v if p and v else None, None),
+    ('inverter', '/Ac/Out/L1/F', 'data', 'ac_output_freq', None, None),
+    ('inverter', '/Temperature', 'data', 'inverter_heat_sink_temp', None, None),
+    ('inverter', '/ErrorCode', 'alerts', ('fault_code', 'inverter_over_temperature', 'over_load'), inverter_error_code, None),
+
+    ('charger', '/State', 'data', 'pv1_input_power', lambda p: 3 if p and p > 0 else 0, None),
+    ('charger', '/Pv/0/V', 'data', 'pv1_input_voltage', None, None),
+    ('charger', '/Pv/V', 'data', 'pv1_input_voltage', None, None),
+    ('charger', '/Pv/0/P', 'data', 'pv1_input_power', None, None),
+    ('charger', '/Yield/Power', 'data', 'pv1_input_power', None, None),
+    ('charger', '/Yield/User', 'generated', 'wh', yield_kwh, None),
+    ('charger', '/Yield/System', 'generated', 'wh', yield_kwh, None),
+    ('charger', '/MppOperationMode', 'data', 'pv1_input_power', lambda p: 2 if p and p > 0 else 0, None),
+    # Maximum charge current and charge voltage, must be written every 60 seconds.
+    # Used by GX device if there is a BMS or user limit.
+    ('charger', '/Link/ChargeCurrent', 'rated', 'max_charging_current', None, None),
+    ('charger', '/Link/ChargeVoltage', 'rated', 'battery_bulk_voltage', None, None),
+    ('charger', '/DC/0/Temperature', 'data', 'mppt1_charger_temperature', None, None),
+    ('charger', '/Dc/0/Voltage', 'data', 'battery_voltage', None, None),
+    ('charger', '/Dc/0/Current', 'data', 'battery_charge_current', None, None),
+    ('charger', '/ErrorCode', 'alerts', ('fault_code', 'inverter_over_temperature', 'mppt1_overload_warning'), charger_error_code, None),
+
+    ('charger', '/History/Overall/MaxPvVoltage', 'data', 'pv1_input_voltage', None, max),
+    ('charger', '/History/Overall/MaxPower', 'data', 'pv1_input_power', None, max),
+    ('charger', '/History/Overall/MaxBatteryVoltage', 'data', 'battery_voltage', None, max),
+    ('charger', '/History/Overall/MinBatteryVoltage', 'data', 'battery_voltage', None, min),
+    ('charger', '/History/Overall/MaxBatteryCurrent', 'data', 'battery_charge_current', None, max),
+)
+# Single fields normalized to tuples once, so publishing never has to check
+PUBLISH_TABLE = tuple((service, path, result, fields if isinstance(fields, tuple) else (fields,), transform, reducer)
+                      for service, path, result, fields, transform, reducer in PUBLISH_TABLE)
+
+class PublishFilter(object):
+    """
+    Decides whether a new value is worth a D-Bus signal.
+    Unchanged values are dropped, then per-path deadbands (absolute, in the
+    path's unit) and minimum publish intervals (ms) are applied. A value held
+    back by the interval is offered again on the next cycle, so the latest one
+    goes out as soon as the interval elapsed.
+    """
+    def __init__(self, deadbands=None, intervals=None):
+        self.deadbands = dict(deadbands or {})
+        self.intervals = {path: interval / 1000 for path, interval in (intervals or {}).items()}
+        self._last = {}
+
+        # Counters
+        self.published = 0
+        self.unchanged = 0
+        self.suppressed = 0
+        self.coalesced = 0
+
+    def accept(self, key, path, value):
+        now = time.monotonic()
+        last = self._last.get(key)
+        if last is not None:
+            previous, when = last
+            if previous == value:
+                self.unchanged += 1
+                return False
+            deadband = self.deadbands.get(path)
+            if deadband and isinstance(value, (int, float)) and isinstance(previous, (int, float)) \
+                    and abs(value - previous) <= deadband:
+                self.suppressed += 1
+                return False
+            interval = self.intervals.get(path)
+            if interval and now - when < interval:
+                self.coalesced += 1
+                return False
+        self._last[key] = (value, now)
+        self.published += 1
+        return True
+
+    def stats(self):
+        return {'published': self.published, 'unchanged': self.unchanged,
+                'suppressed': self.suppressed, 'coalesced': self.coalesced}
+
+class PollScheduler(object):
+    """
+    Poll ticks aligned on a fixed grid, that never overlap and never drift.
+    The next tick is only armed once the current cycle completed, on the first
+    slot of the grid still in the future: a slow cycle skips slots instead of
+    shifting every later tick.
+
+    The period adapts between `floor` and `ceiling` (ms). It shrinks toward
+    the floor while cycles complete well within it, goes back toward the
+    nominal period when they get slower, and backs off exponentially while
+    polls keep failing.
+    """
+    def __init__(self, callback, period, floor=None, ceiling=None):
+        self.nominal = period
+        self.floor = min(floor or period, period)
+        self.ceiling = max(ceiling or period, period)
+        self.period = period
+        self.failures = 0
+        self._callback = callback
+        self._anchor = None
+        self._next = None
+        self._source = None
+        self._running = False
+
+    @property
+    def scale(self):
+        return self.period / self.nominal
+
+    def start(self, delay=None):
+        # (Re)arm the next tick, a running cycle arms it itself when done
+        if self._running:
+            return
+        if self._source is not None:
+            GLib.source_remove(self._source)
+        self._arm(time.monotonic() + (self.period if delay is None else delay) / 1000)
+
+    def _arm(self, when):
+        self._next = when
+        self._source = GLib.timeout_add(max(0, int(round((when - time.monotonic()) * 1000))), self._fire)
+
+    def _fire(self):
+        self._source = None
+        self._running = True
+        self._anchor = self._next
+        self._callback()
+        return False
+
+    def cycle_done(self, seconds, ok):
+        self._running = False
+        if ok:
+            self.failures = 0
+            if self.period > self.nominal:
+                # Recovered from a backoff
+                self.period = self.nominal
+            elif seconds * 1000 < self.period / 4:
+                # Fast answers, poll faster
+                self.period = max(self.floor, self.period * 3 / 4)
+            elif seconds * 1000 > self.period / 2:
+                # Slower answers, back toward the nominal period
+                self.period = min(self.nominal, self.period * 3 / 2)
+        else:
+            self.failures += 1
+            self.period = min(self.ceiling, self.nominal * 2 ** self.failures)
+
+        now = time.monotonic()
+        anchor = self._anchor if self._anchor is not None else now
+        period = self.period / 1000
+        slots = max(1, math.ceil((now - anchor) / period))
+        self._arm(anchor + slots * period)
+
+class CommandSchedule(object):
+    """
+    Per-command refresh cadence, in milliseconds, with the last result cached.
+    An interval of 0 fetches the command once, and again after invalidate().
+    A command is due when less than `slack` ms remain before its interval, so
+    that tick jitter does not push it to the next tick.
+    """
+    def __init__(self, intervals, slack=0):
+        self.intervals = dict(intervals)
+        self.slack = slack
+        self._results = {}
+        self._fetched = {}
+
+    def due(self, scale=1.0):
+        # scale stretches (backoff) or shrinks (fast polling) every cadence alike
+        now = time.monotonic()
+        commands = []
+        for command, interval in self.intervals.items():
+            last = self._fetched.get(command)
+            if last is None or (interval > 0 and (now - last) * 1000 >= (interval - self.slack) * scale):
+                commands.append(command)
+        return commands
+
+    def store(self, command, result):
+        self._results[command] = result
+        self._fetched[command] = time.monotonic()
+
+    def get(self, command):
+        return self._results.get(command)
+
+    def invalidate(self, command):
+        self._fetched.pop(command, None)
+
+class DailyHistory(object):
+    """
+    Per-day production history, kept in a ring of fixed-size records in a
+    memory-mapped file so that it survives restarts. Day 0 is today, missed
+    days are stored empty so that day N is always N days ago.
+
+    Samples only update the records in memory, they reach the file every
+    `flushInterval` seconds, at midnight and on close, to spare the SD card.
+    Without a usable file the history is simply kept in memory.
+    """
+    MAGIC = b'MPPH'
+    VERSION = 2
+    HEADER = struct.Struct('<4sHHII')       # magic, version, days, head slot, record count
+    RECORD = struct.Struct('<II6f4I')
+    FIELDS = ('day', 'baseWh', 'yield', 'maxPower', 'maxPvVoltage', 'minBatteryVoltage',
+              'maxBatteryVoltage', 'maxBatteryCurrent', 'timeInBulk', 'timeInAbsorption', 'timeInFloat',
+              'synced')
+    MAX_SAMPLE = 60     # s, longer gaps between samples are not counted as time in a stage
+
+    def __init__(self, path, days=31, flushInterval=600):
+        self.path = path
+        self.days = days
+        self.flushInterval = flushInterval
+        self._records = [None] * days
+        self._head = 0
+        self._count = 0
+        self._map = None
+        self._dirty = set()
+        self._lastFlush = time.monotonic()
+        self._lastSample = None
+        self._lastTotalWh = None
+        self._stage = None
+        if path:
+            self._open()
+
+    def _open(self):
+        size = self.HEADER.size + self.days * self.RECORD.size
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+                self._map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logging.warning(f"History kept in memory only, cannot map {self.path}: {e}")
+            return
+
+        magic, version, days, head, count = self.HEADER.unpack_from(self._map, 0)
+        if (magic, version, days) != (self.MAGIC, self.VERSION, self.days):
+            if magic != bytes(4):
+                logging.warning(f"Discarding history in {self.path}, written with another layout")
+            self._map[:] = bytes(size)
+            self._writeHeader()
+            return
+        self._head, self._count = head % days, min(count, days)
+        for n in range(self._count):
+            slot = (self._head - n) % days
+            self._records[slot] = dict(zip(self.FIELDS, self.RECORD.unpack_from(self._map, self._offset(slot))))
+        logging.info(f"History: {self._count} days loaded from {self.path}")
+
+    def _offset(self, slot):
+        return self.HEADER.size + slot * self.RECORD.size
+
+    def _writeHeader(self):
+        self.HEADER.pack_into(self._map, 0, self.MAGIC, self.VERSION, self.days, self._head, self._count)
+
+    @property
+    def available(self):
+        return self._count
+
+    def day(self, n):
+        # Record of n days ago, None if not stored
+        if n >= self._count:
+            return None
+        return self._records[(self._head - n) % self.days]
+
+    def overall(self, field, reducer):
+        values = [record[field] for record in self._records if record and record[field]]
+        return reducer(values) if values else None
+
+    def _today(self):
+        # Today's record, rolling the ring over when the date changed
+        today = datetime.date.today().toordinal()
+        current = self.day(0)
+        if current and current['day'] >= today:
+            return current, False
+
+        record = dict.fromkeys(self.FIELDS, 0)
+        if current and current['day'] == today - 1 and current['baseWh']:
+            # Yesterday's closing counter, nothing produced since midnight is lost
+            record['baseWh'] = current['baseWh'] + int(round(current['yield'] * 1000))
+        first = today - min(today - current['day'], self.days) + 1 if current else today
+        for ordinal in range(first, today + 1):
+            if self._count:
+                self._head = (self._head + 1) % self.days
+            self._count = min(self._count + 1, self.days)
+            self._records[self._head] = dict(record, day=ordinal) if ordinal < today else record
+            self._dirty.add(self._head)
+        record['day'] = today
+        self._stage = None
+        return record, True
+
+    def _chargeStage(self, data, rated):
+        # The P18 status has no charge stage: estimated from the battery
+        # voltage against the rated bulk and float voltages while charging
+        current = data.get('battery_charge_current')
+        voltage = data.get('battery_voltage')
+        bulk = rated.get('battery_bulk_voltage')
+        floating = rated.get('battery_float_voltage')
+        if not current or voltage is None:
+            stage = None
+        elif bulk and voltage >= bulk - 0.2:
+            stage = 'Absorption'
+        elif self._stage in ('Absorption', 'Float') and floating and voltage >= floating - 0.2:
+            stage = 'Float'
+        else:
+            stage = 'Bulk'
+        self._stage = stage
+        return stage
+
+    def update(self, data, rated, totalWh):
+        """Account one status sample. Returns True when a new day started."""
+        now = time.monotonic()
+        elapsed = min(now - self._lastSample, self.MAX_SAMPLE) if self._lastSample is not None else 0
+        self._lastSample = now
+
+        record, rolled = self._today()
+        if totalWh is not None:
+            self._lastTotalWh = totalWh
+            if not record['baseWh'] or totalWh < record['baseWh']:
+                record['baseWh'] = totalWh
+            record['yield'] = (totalWh - record['baseWh']) / 1000
+
+        power = data.get('pv1_input_power')
+        if power is not None:
+            record['maxPower'] = max(record['maxPower'], power)
+        pvVoltage = data.get('pv1_input_voltage')
+        if pvVoltage is not None:
+            record['maxPvVoltage'] = max(record['maxPvVoltage'], pvVoltage)
+        voltage = data.get('battery_voltage')
+        if voltage:
+            record['minBatteryVoltage'] = min(record['minBatteryVoltage'] or voltage, voltage)
+            record['maxBatteryVoltage'] = max(record['maxBatteryVoltage'], voltage)
+        current = data.get('battery_charge_current')
+        if current is not None:
+            record['maxBatteryCurrent'] = max(record['maxBatteryCurrent'], current)
+        stage = self._chargeStage(data, rated)
+        if stage:
+            record['timeIn' + stage] += elapsed
+
+        self._dirty.add(self._head)
+        self.flush(force=rolled)
+        return rolled
+
+    def unsynced(self):
+        # Past days of the window whose yield was not read from the inverter, latest first
+        today = datetime.date.today().toordinal()
+        for n in range(1, self.days):
+            record = self.day(n)
+            if record is None or not record['synced']:
+                yield today - n
+
+    def backfill(self, ordinal, kwh):
+        """Set the yield of a day as counted by the inverter."""
+        current = self.day(0)
+        n = current['day'] - ordinal if current else -1
+        if n < 0 or n >= self.days:
+            return
+        # Days before the oldest record are added behind it
+        while self._count <= n:
+            slot = (self._head - self._count) % self.days
+            self._records[slot] = dict(dict.fromkeys(self.FIELDS, 0), day=current['day'] - self._count)
+            self._dirty.add(slot)
+            self._count += 1
+
+        slot = (self._head - n) % self.days
+        record = self._records[slot]
+        record['yield'] = kwh
+        if n:
+            record['synced'] = 1
+        elif self._lastTotalWh is not None:
+            # Today goes on from the total counter, re-anchored on the inverter's own count
+            record['baseWh'] = max(0, self._lastTotalWh - int(round(kwh * 1000)))
+        self._dirty.add(slot)
+
+    def flush(self, force=False):
+        if self._map is None or not self._dirty:
+            return
+        if not force and time.monotonic() - self._lastFlush < self.flushInterval:
+            return
+        for slot in self._dirty:
+            record = self._records[slot]
+            values = [int(record[field]) if field.startswith(('day', 'baseWh', 'timeIn', 'synced')) else record[field]
+                      for field in self.FIELDS]
+            self.RECORD.pack_into(self._map, self._offset(slot), *values)
+        self._writeHeader()
+        self._map.flush()
+        self._dirty.clear()
+        self._lastFlush = time.monotonic()
+
+    def close(self):
+        self.flush(force=True)
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+class HistorySync(object):
+    """
+    Reads the daily yield counted by the inverter into a DailyHistory.
+    Past days of the window are read once, then only today every `interval`
+    seconds. The poll runs at most one of these queries, after its own
+    commands and only when time is left in the cycle. A failed query is
+    retried on the next poll, the sync is only given up when the inverter
+    refused it MAX_ERRORS times in a row without ever answering. A past day
+    that failed or came without a yield DAY_ERRORS times is left out, so
+    the older ones still get their turn.
+    """
+    COMMAND = 'get-day-generated'
+    MAX_ERRORS = 5
+    DAY_ERRORS = 3
+
+    def __init__(self, history, interval=300):
+        self.history = history
+        self.interval = interval
+        self.enabled = interval > 0
+        self.errors = 0
+        self._supported = False
+        self._dayErrors = {}    # ordinal -> failed queries of a past day
+        self._lastToday = None
+
+    def next(self):
+        # (command, params, ordinal) of the next query, None when nothing is due
+        if not self.enabled:
+            return None
+        today = datetime.date.today().toordinal()
+        if self._lastToday is None or time.monotonic() - self._lastToday >= self.interval:
+            ordinal = today
+        else:
+            ordinal = next((ordinal for ordinal in self.history.unsynced()
+                            if self._dayErrors.get(ordinal, 0) < self.DAY_ERRORS), None)
+            if ordinal is None:
+                return None
+        day = datetime.date.fromordinal(ordinal)
+        return self.COMMAND, (day.year, day.month, day.day), ordinal
+
+    def done(self, ordinal, result):
+        self.errors = 0
+        self._supported = True
+        if ordinal == datetime.date.today().toordinal():
+            self._lastToday = time.monotonic()
+        wh = flatten_fields(result).get('wh')
+        if wh is not None:
+            self.history.backfill(ordinal, wh / 1000)
+        else:
+            self._day_failed(ordinal)
+
+    def _day_failed(self, ordinal):
+        self._dayErrors[ordinal] = self._dayErrors.get(ordinal, 0) + 1
+        # Days out of the window will not be asked again
+        oldest = datetime.date.today().toordinal() - self.history.days
+        for day in [day for day in self._dayErrors if day <= oldest]:
+            del self._dayErrors[day]
+
+    def failed(self, ordinal, error, refused=True):
+        self._day_failed(ordinal)
+        if not refused:
+            logging.debug(f"Daily energy query for day {ordinal} failed ({error}), retrying on the next poll")
+            return
+        self.errors += 1
+        if self._supported or self.errors < self.MAX_ERRORS:
+            logging.debug(f"Daily energy query failed ({error}), retrying on the next poll")
+            return
+        logging.warning(f"Daily energy not available from the inverter ({error}), history sync disabled")
+        self.enabled = False
+
+# /History/Daily/N/<name> from the stored day: (name, field, scale)
+HISTORY_DAILY = (
+    ('Yield', 'yield', 1),
+    ('MaxPower', 'maxPower', 1),
+    ('MaxPvVoltage', 'maxPvVoltage', 1),
+    ('MinBatteryVoltage', 'minBatteryVoltage', 1),
+    ('MaxBatteryVoltage', 'maxBatteryVoltage', 1),
+    ('MaxBatteryCurrent', 'maxBatteryCurrent', 1),
+    ('TimeInBulk', 'timeInBulk', 1 / 60),       # minutes
+    ('TimeInAbsorption', 'timeInAbsorption', 1 / 60),
+    ('TimeInFloat', 'timeInFloat', 1 / 60),
+)
+# Overall extremes of PUBLISH_TABLE, seeded from the stored days at startup
+HISTORY_OVERALL = {
+    '/History/Overall/MaxPvVoltage': ('maxPvVoltage', max),
+    '/History/Overall/MaxPower': ('maxPower', max),
+    '/History/Overall/MaxBatteryVoltage': ('maxBatteryVoltage', max),
+    '/History/Overall/MinBatteryVoltage': ('minBatteryVoltage', min),
+    '/History/Overall/MaxBatteryCurrent': ('maxBatteryCurrent', max),
+}
+class TelemetryRecorder(object):
+    """
+    Append-only recording of the raw poll results, for diagnosis and replay.
+    Samples are grouped in blocks stored column by column (one list per
+    field, so repeated values compress well) and zlib compressed. A block is
+    written once `flushInterval` seconds of samples were collected and on
+    close. The file is rotated to <path>.1 when it grows over `maxSize`.
+
+    Block: BLOCK header (magic, samples, start time, payload length) and the
+    compressed JSON {"t": [ms since start], "c": {"name/field/...": [values]}}
+    """
+    MAGIC = b'MPPR'
+    BLOCK = struct.Struct('<4sIdI')
+
+    def __init__(self, path, maxSize=1048576, flushInterval=60):
+        self.path = path
+        self.maxSize = maxSize
+        self.flushInterval = flushInterval
+        self._start = None
+        self._times = []
+        self._samples = []
+
+        # Counters
+        self.samples = 0
+        self.blocks = 0
+        self.bytes = 0
+
+    def record(self, results):
+        now = time.time()
+        if self._start is None:
+            self._start = now
+        columns = {}
+        _flatten(results, '', columns)
+        self._times.append(int(round((now - self._start) * 1000)))
+        self._samples.append(columns)
+        self.samples += 1
+        if now - self._start >= self.flushInterval:
+            self.flush()
+
+    def flush(self):
+        if not self._samples:
+            return
+        keys = {}
+        for sample in self._samples:
+            keys.update(dict.fromkeys(sample))
+        columns = {key: [sample.get(key) for sample in self._samples] for key in keys}
+        import zlib
+        payload = zlib.compress(json.dumps({'t': self._times, 'c': columns}, separators=(',', ':')).encode(), 9)
+        block = self.BLOCK.pack(self.MAGIC, len(self._samples), self._start, len(payload)) + payload
+        self._start = None
+        self._times = []
+        self._samples = []
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) + len(block) > self.maxSize:
+                os.replace(self.path, self.path + '.1')
+            with open(self.path, 'ab') as record_file:
+                record_file.write(block)
+        except OSError as e:
+            logging.warning(f"Telemetry block dropped, cannot write {self.path}: {e}")
+            return
+        self.blocks += 1
+        self.bytes += len(block)
+
+    def close(self):
+        self.flush()
+
+def _flatten(value, prefix, columns):
+    for key, item in value.items():
+        if isinstance(item, StatusRecord):
+            # Recorded in the shape of the JSON answer
+            item = {'data': dict(item.items())} if prefix == '' else dict(item.items())
+        if isinstance(item, dict) and item:
+            _flatten(item, prefix + key + '/', columns)
+        else:
+            columns[prefix + key] = item
+
+def read_recording(path):
+    """Yield (timestamp, results) from a TelemetryRecorder file."""
+    import zlib
+    with open(path, 'rb') as record_file:
+        while True:
+            header = record_file.read(TelemetryRecorder.BLOCK.size)
+            if len(header) < TelemetryRecorder.BLOCK.size:
+                return
+            magic, count, start, length = TelemetryRecorder.BLOCK.unpack(header)
+            if magic != TelemetryRecorder.MAGIC:
+                raise ValueError(f"{path} is not a telemetry recording")
+            block = json.loads(zlib.decompress(record_file.read(length)))
+            for n, offset in enumerate(block['t'][:count]):
+                results = {}
+                for key, values in block['c'].items():
+                    if values[n] is None:
+                        continue
+                    *parents, leaf = key.split('/')
+                    node = results
+                    for parent in parents:
+                        node = node.setdefault(parent, {})
+                    node[leaf] = values[n]
+                yield start + offset / 1000, results
 
 # Allow to have multiple DBUS connections
 class SystemBus(dbus.bus.BusConnection):
@@ -183,22 +1808,91 @@ class SessionBus(dbus.bus.BusConnection):
 def dbusconnection():
     return SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else SystemBus()
 
-class DbusMppSolarService(object):
-    def __init__(self, tty, deviceinstance, productname='MPPSolar', connection='MPPSolar interface', json_file_path='/data/etc/dbus-mppsolar/config.json'):
-        global numberOfChargers
-        global port
-        global usb_path
+class ParallelController(object):
+    """
+    Coordinates inverters running in parallel on the same battery.
+    The BMS charge limits are read once for the whole stack and the charge
+    current is split evenly across the members of config.json. Each member writes its own share
+    from its poll, through its setpoint cache, so a change is sent once per
+    inverter. The totals of the stack are published on the master's inverter
+    service.
+    """
+    PATHS = ('/Parallel/Count', '/Parallel/Pv/P', '/Parallel/Ac/Out/P', '/Parallel/Dc/Current')
+    STALE = 60   # seconds without a reading before a member is left out of the totals
+
+    def __init__(self, config):
+        self.ttys = [tty for tty, device in config.items() if device.get('parallel', False)]
+        # The master is the member with the lowest device instance
+        self.master = min(self.ttys, key=lambda tty: config[tty].get('deviceinstance', 0)) if self.ttys else None
+        self._members = []
+        self._readings = {}
+
+    def is_member(self, tty):
+        return tty in self.ttys
+
+    def join(self, service):
+        self._members.append(service)
+
+    def setpoints(self):
+        # (charge voltage, charge current per inverter), None when unknown
+        monitor = get_battery_monitor()
+        if not monitor.service or not self._members:
+            return None, None
+        current = monitor.get_value('/Info/MaxChargeCurrent')
+        if current is not None:
+            # Split across every configured member: one not attached keeps
+            # charging at its last setting and must keep its share
+            current = current / len(self.ttys)
+        return monitor.get_value('/Info/MaxChargeVoltage'), current
+
+    def report(self, service, pvPower, outputPower, chargeCurrent):
+        now = time.monotonic()
+        self._readings[service.tty] = (now, pvPower or 0, outputPower or 0, chargeCurrent or 0)
+        readings = [r for r in self._readings.values() if now - r[0] < self.STALE]
+
+        master = next((m for m in self._members if m.tty == self.master), None)
+        if master is None:
+            return
+        with master._dbusinverter as i:
+            i['/Parallel/Count'] = len(readings)
+            i['/Parallel/Pv/P'] = sum(r[1] for r in readings)
+            i['/Parallel/Ac/Out/P'] = sum(r[2] for r in readings)
+            i['/Parallel/Dc/Current'] = sum(r[3] for r in readings)
 
+class DbusMppSolarService(object):
+    def __init__(self, tty, deviceinstance, productname='MPPSolar', connection='MPPSolar interface', json_file_path='/data/etc/dbus-mppsolar/config.json', asyncPoll=None, parallel=None, replay=False, slim=False):
+        self.tty = tty
+        self.replay = replay
+        self.slim = slim
+        self._inverter = None
+        self._parallel = parallel if parallel is not None and parallel.is_member(tty) else None
+        self.parallelId = 0
         self._queued_updates = []
-        
-        # For production history
-        energyProductionDays = int(1)
-        currentDay = 0
-        minBatteryVoltage = 100.0
-        maxBatteryVoltage = 0
-        maxBatteryCurrent = 0
-        maxPVPower = 0
-        maxPVVoltage = 0
+        self.asyncPoll = True
+        self.updateInterval = 10000
+        self._lastChargeVoltage = None
+        self._reduced = {}
+        self._cycleStart = None
+        self._cycleOk = False
+        self._static = None
+        self._staticErrors = collections.Counter()
+        # Reused from one poll to the next
+        self._results = {}
+        self._fields = {}
+        self._fieldSources = {}
+        self._stats = {}
+        self._statsPublished = time.monotonic()
+        self.statsInterval = 30
+        minUpdateInterval = maxBackoff = None
+        publishDeadbands = publishIntervals = {}
+        pollIntervals = {}
+        historyFile = None
+        historyDays = 31
+        historyFlushInterval = 600
+        historySyncInterval = 300
+        recordFile = None
+        recordMaxSize = 1048576
+        recordFlushInterval = 60
 
         # Get the name from config file if available
         if os.path.exists(json_file_path):
@@ -208,25 +1902,75 @@ class DbusMppSolarService(object):
                 deviceinstance = config[tty].get('deviceinstance', 0)
                 productname_value = config[tty].get('productname', None)
                 self.updateInterval = config[tty].get('updateInterval', 10000)
+                self.asyncPoll = config[tty].get('asyncPoll', True) if asyncPoll is None else asyncPoll
+                pollIntervals = config[tty].get('pollIntervals', {})
+                publishDeadbands = config[tty].get('publishDeadbands', {})
+                publishIntervals = config[tty].get('publishMinInterval', {})
+                minUpdateInterval = config[tty].get('minUpdateInterval', None)
+                maxBackoff = config[tty].get('maxBackoff', 120000)
                 if productname_value is not None:
                     productname = productname_value
                     logging.info("Product named from config : {}".format(productname_value))
                 numberOfChargers = config[tty].get('numberOfChargers', 1)
-
-                port = 8305 + deviceinstance
-                usb_path = tty
-                start_inverterd(usb_path)
-
-        if not os.path.exists("{}".format(usb_path)):
-            logging.warning("Inverter not connected on {}".format(tty))
-            sys.exit()
+                inverterdDelay = config[tty].get('inverterdDelay', 1000)
+                backend = config[tty].get('backend', 'inverterd')
+                hidrawDelay = config[tty].get('hidrawDelay', 100)
+                outputFormat = config[tty].get('outputFormat', None)
+                self.parallelId = config[tty].get('parallelId', 0)
+                historyFile = config[tty].get('historyFile', '/data/etc/dbus-mppsolar/history-{}.bin'.format(deviceinstance))
+                historyDays = config[tty].get('historyDays', historyDays)
+                historyFlushInterval = config[tty].get('historyFlushInterval', historyFlushInterval)
+                historySyncInterval = config[tty].get('historySyncInterval', historySyncInterval)
+                recordFile = config[tty].get('recordFile', None)
+                recordMaxSize = config[tty].get('recordMaxSize', recordMaxSize)
+                recordFlushInterval = config[tty].get('recordFlushInterval', recordFlushInterval)
+                self.statsInterval = config[tty].get('statsInterval', self.statsInterval)
+
+                self._inverter = Inverter(tty, 8305 + deviceinstance, host, numberOfChargers, inverterdDelay, backend, hidrawDelay, outputFormat)
+                setpoints = self._inverter.setpoints
+                setpoints.deadband = config[tty].get('setpointDeadband', setpoints.deadband)
+                setpoints.refresh = config[tty].get('setpointRefresh', setpoints.refresh)
+
+        if replay:
+            # Fed from a recording: no inverter, nothing written to disk.
+            # Away from the hardware the tty may have no config entry, the
+            # defaults then only back the statistics.
+            historyFile = recordFile = None
+            if self._inverter is None:
+                self._inverter = Inverter(tty, 8305 + deviceinstance, host)
+        elif self._inverter is None or not os.path.exists(self._inverter.usb_path):
+            raise InverterNotConnected(f"Inverter not connected on {tty}")
+        else:
+            start_inverterd(self._inverter)
 
         logging.info(f"Connected to inverter on {tty}, setting up dbus with /DeviceInstance = {deviceinstance}")
+
+        # Commands without their own cadence keep the historical updateInterval,
+        # the poll ticks as fast as the fastest one
+        intervals = {command: pollIntervals.get(command, self.updateInterval) for _, command in POLL_COMMANDS}
+        self.pollTick = min([self.updateInterval] + [interval for interval in intervals.values() if interval > 0])
+        self._schedule = CommandSchedule(intervals, slack=self.pollTick / 2)
+        self._publishFilter = PublishFilter(publishDeadbands, publishIntervals)
+        self._history = DailyHistory(historyFile, historyDays, historyFlushInterval)
+        self._historySync = HistorySync(self._history, historySyncInterval)
+        self._recorder = TelemetryRecorder(recordFile, recordMaxSize, recordFlushInterval) if recordFile else None
+        # The overall extremes carry on from the stored days
+        for path, (field, reducer) in HISTORY_OVERALL.items():
+            value = self._history.overall(field, reducer)
+            if value is not None:
+                self._reduced[('charger', path)] = value
+        self._historyPaths = [[(f'/History/Daily/{n}/{name}', field, scale) for name, field, scale in HISTORY_DAILY]
+                              for n in range(self._history.days)]
         
         # Create the services
         hidraw = tty.strip('/dev/')
-        self._dbusinverter = VeDbusService(f'com.victronenergy.inverter.mppsolar-inverter.{hidraw}', bus=dbusconnection(), register=False)
-        self._dbusmppt = VeDbusService(f'com.victronenergy.solarcharger.mppsolar-charger.{hidraw}', bus=dbusconnection(), register=False)
+
+        # Inverter I/O runs on this worker when polling asynchronously, so the
+        # GLib main loop keeps serving D-Bus while the inverter is slow
+        if self.asyncPoll:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'poll-{hidraw}')
+        self._dbusinverter = VeDbusService(f'com.victronenergy.inverter.mppsolar-inverter.{hidraw}', bus=get_service_bus(), register=False)
+        self._dbusmppt = VeDbusService(f'com.victronenergy.solarcharger.mppsolar-charger.{hidraw}', bus=get_service_bus(), register=False)
 
         # Set up default paths
         self.setupInverterDefaultPaths(self._dbusinverter, connection, deviceinstance, f"Inverter {productname}")
@@ -238,9 +1982,13 @@ class DbusMppSolarService(object):
         self._dbusinverter.add_path('/Ac/Out/L1/I', 0)
         self._dbusinverter.add_path('/Ac/Out/L1/P', 0)
         self._dbusinverter.add_path('/Ac/Out/L1/F', 0)
-        self._dbusinverter.add_path('/Mode', 0)                     #<- Switch position: 2=Inverter on; 4=Off; 5=Low Power/ECO
+        self._dbusinverter.add_path('/Mode', 0, writeable=True, onchangecallback=self._change)   #<- Switch position: 2=Inverter on; 4=Off; 5=Low Power/ECO
         self._dbusinverter.add_path('/State', 0)                    #<- 0=Off; 1=Low Power; 2=Fault; 9=Inverting
         self._dbusinverter.add_path('/Temperature', 123)
+        self._dbusinverter.add_path('/ErrorCode', 0)
+        if self._parallel and self._parallel.master == tty:
+            for path in ParallelController.PATHS:
+                self._dbusinverter.add_path(path, 0)
 
         logging.info(f"Paths for Inverter created.")
 
@@ -287,7 +2035,9 @@ class DbusMppSolarService(object):
         self._dbusmppt.add_path('/Relay/0/State', None)
         
         # history
-        self._dbusmppt.add_path('/History/Overall/DaysAvailable', 1)
+        self._dbusmppt.add_path('/History/Overall/DaysAvailable', self._history.available)
+        for path, value in self._historyValues(range(self._history.days)):
+            self._dbusmppt.add_path(path, value)
 
         # history daily
         self._dbusmppt.add_path("/History/Overall/Yield", 0)
@@ -312,26 +2062,43 @@ class DbusMppSolarService(object):
 
         logging.info(f"Paths for 'solarcharger' created.")
 
+        # Statistics, on the inverter service only
+        for path, value in self._statsValues().items():
+            self._dbusinverter.add_path(path, value)
+
         self._dbusinverter.register()
         self._dbusmppt.register()
+        if self._parallel:
+            self._parallel.join(self)
 
         logging.info(f'Added to D-Bus: {self._dbusinverter}')
         logging.info(f'Added to D-Bus: {self._dbusmppt}')
 
-        GLib.timeout_add(self.updateInterval, self._update)
+        self._scheduler = PollScheduler(self._update, self.pollTick, minUpdateInterval, maxBackoff)
+        if not replay:
+            # First poll as soon as inverterd answers, and right after each restart
+            self._inverter.supervisor.on_ready.append(self._inverterdReady)
+            if self._inverter.supervisor.ready.is_set():
+                self._scheduler.start(delay=0)
+
+    def _inverterdReady(self):
+        logging.info(f"inverterd ready, polling {self.tty} now")
+        self._scheduler.start(delay=0)
+        return False
     
     def setupInverterDefaultPaths(self, service, connection, deviceinstance, productname):
         # Create the management objects, as specified in the ccgx dbus-api document
         service.add_path('/Mgmt/ProcessName', __file__)
-        service.add_path('/Mgmt/ProcessVersion', 'version f{VERSION}, and running on Python ' + platform.python_version())
+        service.add_path('/Mgmt/ProcessVersion', 'version f{VERSION}, and running on Python ' + sys.version.split()[0])
         service.add_path('/Mgmt/Connection', connection)
 
         # Create the mandatory objects
         service.add_path('/DeviceInstance', deviceinstance)
-        service.add_path('/ProductId', None)
+        service.add_path('/ProductId', PRODUCT_ID)
         service.add_path('/ProductName', productname)
         service.add_path('/FirmwareVersion', None)
         service.add_path('/HardwareVersion', None)
+        service.add_path('/Serial', None)
         service.add_path('/Connected', 1)
 
         # Create the paths for modifying the system manually
@@ -342,15 +2109,16 @@ class DbusMppSolarService(object):
     def setupChargerDefaultPaths(self, service, connection, deviceinstance, productname):
         # Create the management objects, as specified in the ccgx dbus-api document
         service.add_path('/Mgmt/ProcessName', __file__)
-        service.add_path('/Mgmt/ProcessVersion', 'version f{VERSION}, and running on Python ' + platform.python_version())
+        service.add_path('/Mgmt/ProcessVersion', 'version f{VERSION}, and running on Python ' + sys.version.split()[0])
         service.add_path('/Mgmt/Connection', connection)
 
         # Create the mandatory objects
         service.add_path('/DeviceInstance', deviceinstance)
-        service.add_path('/ProductId', None)
+        service.add_path('/ProductId', PRODUCT_ID)
         service.add_path('/ProductName', productname)
         service.add_path('/FirmwareVersion', None)
         service.add_path('/HardwareVersion', None)
+        service.add_path('/Serial', None)
         service.add_path('/Connected', 1)
 
         # Create the paths for modifying the system manually
@@ -360,16 +2128,80 @@ class DbusMppSolarService(object):
 
     def _updateInternal(self):
         # Store in the paths all values that were updated from _handleChangedValue
+        updates, self._queued_updates = self._queued_updates, []
+
+        # End of a poll cycle, arm the next one
+        if self._cycleStart is not None:
+            duration = time.monotonic() - self._cycleStart
+            self._inverter.stats.cycle_done(duration, self._scheduler.period)
+            self._scheduler.cycle_done(duration, self._cycleOk)
+            self._cycleStart = None
+
         with self._dbusinverter as i, self._dbusmppt as m:
-            for path, value, in self._queued_updates:
+            for path, value, in updates:
                 i[path] = value
                 m[path] = value
-            self._queued_updates = []
+            # Counters move on every poll, they are refreshed on their own slower cadence
+            now = time.monotonic()
+            if now - self._statsPublished >= self.statsInterval:
+                self._statsPublished = now
+                for path, value in self._statsValues().items():
+                    i[path] = value
+
+    def _statsValues(self):
+        stats = self._inverter.stats
+        values = self._stats
+        values['/Mgmt/Stats/Cycle/Count'] = stats.cycles
+        values['/Mgmt/Stats/Cycle/LastMs'] = round(stats.lastCycleMs)
+        values['/Mgmt/Stats/Cycle/MaxMs'] = round(stats.maxCycleMs)
+        values['/Mgmt/Stats/Cycle/Overruns'] = stats.overruns
+        values['/Mgmt/Stats/LastSuccess'] = stats.lastSuccess
+        values['/Mgmt/Stats/Timeouts'] = stats.timeouts
+        values['/Mgmt/Stats/Restarts'] = stats.restarts
+        if self.slim:
+            # Per command timings stay available from the SIGUSR1 dump
+            return values
+        for command, prefix in STATS_PREFIXES.items():
+            command_stats = stats.commands.get(command, {})
+            count = command_stats.get('count', 0)
+            values[prefix + '/Count'] = count
+            values[prefix + '/Errors'] = command_stats.get('errors', 0)
+            values[prefix + '/AvgMs'] = round(command_stats['totalMs'] / count) if count else 0
+            values[prefix + '/MaxMs'] = round(command_stats.get('maxMs', 0))
+            values[prefix + '/LastSuccess'] = command_stats.get('lastSuccess')
+        for group, counters in (('Connection', get_connection(self._inverter).stats()),
+                                ('Setpoints', self._inverter.setpoints.stats()),
+                                ('Queue', self._inverter.queue.stats()),
+                                ('Publish', self._publishFilter.stats())):
+            paths = STATS_GROUP_PATHS.setdefault(group, {})
+            for name, value in counters.items():
+                path = paths.get(name)
+                if path is None:
+                    path = paths[name] = f'/Mgmt/Stats/{group}/{name.capitalize()}'
+                values[path] = value
+        return values
+
+    def _historyValues(self, days):
+        for n in days:
+            record = self._history.day(n)
+            for path, field, scale in self._historyPaths[n]:
+                yield path, round(record[field] * scale, 2) if record else None
 
     def _update(self):
         global mainloop
-        logging.info("{} updating".format(datetime.datetime.now().time()))
+        logger = logging.getLogger()
+        if logger.isEnabledFor(logging.INFO):
+            logging.info("{} updating".format(datetime.datetime.now().time()))
+        if logger.isEnabledFor(logging.DEBUG):
+            logging.debug("inverter link: {}".format(get_connection(self._inverter).stats()))
+            logging.debug("setpoints: {}".format(self._inverter.setpoints.stats()))
+            logging.debug("publishing: {}".format(self._publishFilter.stats()))
+        if self._cycleStart is None:
+            self._cycleStart = time.monotonic()
+            self._cycleOk = False
         try: 
+            if self.asyncPoll:
+                return self._update_async()
             return self._update_PI18()
         except:
             logging.exception('Error in update loop', exc_info=True)
@@ -385,6 +2217,7 @@ class DbusMppSolarService(object):
             mainloop.quit()
             exit
         try: 
+            # Writes are only queued, they never wait for a poll
             return self._change_PI18(path, value)
         except:
             logging.exception('Error in change loop', exc_info=True)
@@ -392,124 +2225,171 @@ class DbusMppSolarService(object):
             return False
 
     def _update_PI18(self):
-        # Update charge voltage
+        results = self._read_PI18(*self._read_setpoints())
+        if results is not None:
+            self._publish_PI18(results)
 
-        battery_service = find_battery_service()
-        generated = data = mode = rated = alerts = {"result": "init", "message": "not initialized"}
+        # Execute updates of previously updated values
+        self._updateInternal()
+        return True
 
-        if battery_service:
-            systemMaxChargeVoltage = VeDbusItemImport(dbusconnection(), battery_service, '/Info/MaxChargeVoltage')
-            systemMaxChargeCurrent = VeDbusItemImport(dbusconnection(), battery_service, '/Info/MaxChargeCurrent')
+    def _update_async(self):
+        # The scheduler only ticks again once this cycle completed, there is
+        # never more than one poll in flight
+        # D-Bus is only touched from the main loop, the worker gets plain values
+        future = self._executor.submit(self._read_PI18, *self._read_setpoints())
+        future.add_done_callback(lambda future: GLib.idle_add(self._poll_done, future))
+        return True
+
+    def _poll_done(self, future):
+        try:
+            results = future.result()
+            if results is not None:
+                self._publish_PI18(results)
+        except:
+            logging.exception('Error in update loop', exc_info=True)
+        self._updateInternal()
+        return False
+
+    def _read_setpoints(self):
+        # (charge voltage, charge current) to apply, the current is only
+        # driven when the split is coordinated across a parallel stack
+        if self._parallel:
+            return self._parallel.setpoints()
+        monitor = get_battery_monitor()
+        if monitor.service:
+            return monitor.get_value('/Info/MaxChargeVoltage'), None
+        return None, None
+
+    def _read_PI18(self, chargeVoltage, chargeCurrent=None):
+        # Inverter I/O only, may run outside of the main loop
+        # Update charge voltage
+        if chargeVoltage is not None:
             try:
-                setMaxChargingVoltage(systemMaxChargeVoltage.get_value(), systemMaxChargeVoltage.get_value())
+                setMaxChargingVoltage(self._inverter, chargeVoltage, chargeVoltage)
+                if chargeVoltage != self._lastChargeVoltage:
+                    # Rated values report the bulk voltage, refresh them
+                    self._schedule.invalidate('get-rated')
+                    self._lastChargeVoltage = chargeVoltage
             except:
                 logging.warning("bulkVoltage and/or floatVoltage not defined.")
+        if chargeCurrent is not None:
+            setMaxChargingCurrent(self._inverter, self.parallelId, chargeCurrent, chargers=1)
         # try:
-        #     setMaxChargingCurrent(0, systemMaxChargeCurrent.get_value())
-        #     setMaxUtilityChargingCurrent(0, systemMaxChargeCurrent.get_value())
+        #     setMaxChargingCurrent(self._inverter, 0, systemMaxChargeCurrent.get_value())
+        #     setMaxUtilityChargingCurrent(self._inverter, 0, systemMaxChargeCurrent.get_value())
         # except:
         #     logging.warning("Max charge current not defined.", exc_info=True)
-        
+
+        results = self._results
+        results.clear()
+        for name, command in POLL_COMMANDS:
+            results[name] = self._schedule.get(command)
         try:
-            generated = runInverterCommands('get-total-generated')
-            data = runInverterCommands('get-status')
-            mode = runInverterCommands('get-mode')
-            rated = runInverterCommands('get-rated')
-            alerts = runInverterCommands('get-errors')
+            # Only the commands whose cadence elapsed, the others are reused
+            for command in self._schedule.due(self._scheduler.scale):
+                result = self._inverter.queue.run(command)
+                self._schedule.store(command, result)
+                results[POLL_RESULT_NAMES[command]] = result
 
         except:
-            results = {
-                "generated": generated,
-                "data": data,
-                "mode": mode,
-                "rated": rated,
-                "alerts": alerts
-            }
-
             # Vérifier s'il y a des erreurs
             for name, result in results.items():
                 if isinstance(result, dict) and result.get("result") == "error":
                     logging.warning(f"Error in update PI18 loop. {name} → {result.get('message')}")
-            self._updateInternal()
-            return True
+            return None
 
-        with self._dbusinverter as i, self._dbusmppt as m:
-            # 0=Off;1=Low Power;2=Fault;9=Inverting
-            invMode = mode.get('data', {}).get('mode', i['/State'])
-            if invMode == 'Battery mode':
-                i['/State'] = 9 # Inverting
-            elif invMode == 'Fault mode':
-                i['/State'] = 2 # Fault mode
-            else:
-                i['/State'] = 0 # OFF
-
-            # Normal operation, read data
-            i['/Dc/0/Voltage'] = data.get('data').get('battery_voltage', {}).get("value", i['/Dc/0/Voltage'])
-
-            i['/Ac/Out/L1/V'] = data.get('data').get('ac_output_voltage', {}).get("value", i['/Ac/Out/L1/V'])
-            i['/Ac/Out/L1/P'] = data.get('data').get('ac_output_active_power', {}).get("value", i['/Ac/Out/L1/P'])
-            if i['/Ac/Out/L1/V'] != 0 and i['/Ac/Out/L1/P'] != 0:
-                output_current = i['/Ac/Out/L1/P'] / i['/Ac/Out/L1/V']
-                i['/Ac/Out/L1/I'] = output_current
-            i['/Ac/Out/L1/F'] = data.get('data').get('ac_output_freq', {}).get("value", i['/Ac/Out/L1/F'])
-            i['/Temperature'] = data.get('data').get('inverter_heat_sink_temp', {}).get("value", i['/Temperature'])
-
-            # Solar charger
-            if data.get('data').get('pv1_input_power', {}).get("value", 0) > 0:
-                m['/State'] = 3
-            else:
-                m['/State'] = 0
-            m['/Pv/0/V'] = data.get('data').get('pv1_input_voltage', {}).get("value", m['/Pv/0/V'])
-            m['/Pv/V'] = data.get('data').get('pv1_input_voltage', {}).get("value", m['/Pv/V'])
-            m['/Pv/0/P'] = data.get('data').get('pv1_input_power', {}).get("value", m['/Pv/0/P'])
-            m['/Yield/Power'] = data.get('data').get('pv1_input_power', {}).get("value", m['/Yield/Power'])
-            if generated.get('data').get('wh') != 0 and generated.get('data').get('wh') != None:
-                m['/Yield/User'] = generated.get('data').get('wh') / 1000
-                m['/Yield/System'] = generated.get('data').get('wh') / 1000
-            m['/MppOperationMode'] = 2 if (data.get('data').get('pv1_input_power', {}).get("value", 0) > 0) else 0
-            m['/Link/ChargeCurrent'] =  rated.get('data').get('max_charging_current', {}).get("value",  m['/Link/ChargeCurrent']) # <- Maximum charge current. Must be written every 60 seconds. Used by GX device if there is a BMS or user limit.
-            m['/Link/ChargeVoltage'] =  rated.get('data').get('battery_bulk_voltage', {}).get("value",  m['/Link/ChargeVoltage']) # <- Charge voltage. Must be written every 60 seconds. Used by GX device to communicate BMS charge voltages.
-            m['/DC/0/Temperature'] = data.get('data').get('mppt1_charger_temperature', {}).get("value", m['/DC/0/Temperature'])
-            m['/Dc/0/Voltage'] = data.get('data').get('battery_voltage', {}).get("value", m['/Dc/0/Voltage'])
-            m['/Dc/0/Current'] = data.get('data').get('battery_charge_current', {}).get("value", m['/Dc/0/Current'])
-
-            # Error code handling
-            if alerts.get('data').get('fault_code') != 0:
-                if alerts.get('data').get('inverter_over_temperature'):
-                    m['/ErrorCode'] = 17
-                if alerts.get('data').get('mppt1_overload_warning'):
-                    m['/ErrorCode'] = 18
-                if alerts.get('data').get('inverter_over_temperature'):
-                    i['/ErrorCode'] = 17
-                if alerts.get('data').get('over_load'):
-                    i['/ErrorCode'] = 18
-            # History
-            # if generatedToday.get("generated_energy_for_day") != 0 and generatedToday.get("generated_energy_for_day") != None:
-            #     m["/History/Overall/Yield"] = generatedToday.get("generated_energy_for_day") / 1000
-            
-            # if generatedToday.get("day") != currentDay:
-            #     # Reset daily history when day change
-            #     currentDay = generatedToday.get("day")
-            #     maxPVVoltage = 0
-            #     maxPVPower = 0
-            #     maxBatteryVoltage = 0
-            #     minBatteryVoltage = 0
-            #     maxBatteryCurrent = 0
-
-            if data.get('data').get('pv1_input_voltage', {}).get("value") != None and data.get('data').get('pv1_input_voltage', {}).get("value") > m["/History/Overall/MaxPvVoltage"]:
-                m["/History/Overall/MaxPvVoltage"] = data.get('data').get('pv1_input_voltage', {}).get("value")
-            if data.get('data').get('pv1_input_power', {}).get("value") != None and data.get('data').get('pv1_input_power', {}).get("value") > m["/History/Overall/MaxPower"]:
-                m["/History/Overall/MaxPower"] = data.get('data').get('pv1_input_power', {}).get("value")
-            if data.get('data').get('battery_voltage', {}).get("value") != None and data.get('data').get('battery_voltage', {}).get("value") > m["/History/Overall/MaxBatteryVoltage"]:
-                m["/History/Overall/MaxBatteryVoltage"] = data.get('data').get('battery_voltage', {}).get("value")
-            if data.get('data').get('battery_voltage', {}).get("value") != None and data.get('data').get('battery_voltage', {}).get("value") < m["/History/Overall/MinBatteryVoltage"]:
-                m["/History/Overall/MinBatteryVoltage"] = data.get('data').get('battery_voltage', {}).get("value")
-            if data.get('data').get('battery_charge_current', {}).get("value") != None and data.get('data').get('battery_charge_current', {}).get("value") > m["/History/Overall/MaxBatteryCurrent"]:
-                m["/History/Overall/MaxBatteryCurrent"] = data.get('data').get('battery_charge_current', {}).get("value")
+        if any(result is None for result in results.values()):
+            return None
 
-        # Execute updates of previously updated values
-        self._updateInternal()
-        return True
+        if self._static is None:
+            try:
+                results['static'] = dict(self._read_static())
+            except Exception:
+                logging.debug("Identification not read, retrying on the next poll", exc_info=True)
+
+        # Low priority: one history query, only when the poll left time for it
+        job = self._historySync.next()
+        if job and time.monotonic() - self._cycleStart < self._scheduler.period / 2000:
+            command, params, ordinal = job
+            try:
+                results['history'] = (ordinal, self._inverter.queue.run(command, params))
+            except InverterError as e:
+                self._historySync.failed(ordinal, e)
+            except Exception as e:
+                self._historySync.failed(ordinal, e, refused=False)
+        return results
+
+    def _read_static(self):
+        for name, command in STATIC_COMMANDS:
+            try:
+                yield name, flatten_fields(self._inverter.queue.run(command))
+            except InverterError:
+                # A glitch is read again on the next poll, a command refused
+                # every time is not supported by this model and left empty
+                self._staticErrors[command] += 1
+                if self._staticErrors[command] < STATIC_MAX_ERRORS:
+                    raise
+                yield name, {}
+
+    def _publish_PI18(self, results):
+        self._cycleOk = True
+        self._inverter.stats.lastSuccess = time.time()
+        history = results.pop('history', None)
+        static = results.pop('static', None)
+        if self._recorder:
+            self._recorder.record(results)
+        # Results reused from the schedule are flat already, the others are
+        # flattened into last cycle's dicts
+        fields = self._fields
+        sources = self._fieldSources
+        for name, result in results.items():
+            if sources.get(name) is not result:
+                sources[name] = result
+                fields[name] = flatten_fields(result, fields.get(name))
+
+        with self._dbusinverter as i, self._dbusmppt as m:
+            services = {'inverter': i, 'charger': m}
+            if static is not None:
+                self._static = static
+                for path, result, field, transform in STATIC_TABLE:
+                    value = static[result].get(field)
+                    if value is not None:
+                        i[path] = m[path] = transform(value) if transform else value
+            for service, path, result, keys, transform, reducer in PUBLISH_TABLE:
+                values = fields[result]
+                if transform:
+                    value = transform(*[values.get(key) for key in keys])
+                else:
+                    value = values.get(keys[0])
+                if value is None:
+                    continue
+
+                key = (service, path)
+                if reducer:
+                    previous = self._reduced.get(key)
+                    if previous is not None:
+                        value = reducer(previous, value)
+                    self._reduced[key] = value
+
+                # Unchanged, within deadband or too recent: not even handed to the service
+                if self._publishFilter.accept(key, path, value):
+                    services[service][path] = value
+
+            # Only today changes, the older days move along at midnight
+            rolled = self._history.update(fields['data'], fields['rated'], fields['generated'].get('wh'))
+            if history:
+                self._historySync.done(*history)
+                rolled = rolled or history[0] != datetime.date.today().toordinal()
+            days = range(self._history.days) if rolled else (0,)
+            for path, value in self._historyValues(days):
+                if self._publishFilter.accept(('charger', path), path, value):
+                    m[path] = value
+            if rolled:
+                m['/History/Overall/DaysAvailable'] = self._history.available
+
+        if self._parallel:
+            self._parallel.report(self, self._dbusmppt['/Yield/Power'], self._dbusinverter['/Ac/Out/L1/P'], self._dbusmppt['/Dc/0/Current'])
 
     def _change_PI18(self, path, value):
         # Link
@@ -524,38 +2404,184 @@ class DbusMppSolarService(object):
 
         # Mode settings
         if path == '/Mode': # 1=Charger Only;2=Inverter Only;3=On;4=Off(?)
-            if value == 1:
-                logging.info("setting mode to 'Charger Only'(Charger=Util) ({})".format(setChargerPriority(1), setOutputSource(1)))
-            elif value == 2:
-                logging.info("setting mode to 'Inverter Only'(Charger=Solar & Output=SBU) ({},{})".format(setChargerPriority(0), setOutputSource(2)))
-            elif value == 3:
-                logging.info("setting mode to 'ON=Charge+Invert'(Charger=Util & Output=SBU) ({},{})".format(setChargerPriority(1), setOutputSource(2)))
-            elif value == 4:
-                logging.info("setting mode to 'OFF'(Charger=Solar) ({})".format(setChargerPriority(3), setOutputSource(2)))
-            else:
+            if value not in MODE_SETTINGS:
                 logging.info("setting mode not understood ({})".format(value))
-            self._queued_updates.append((path, value))        
+                return True
+            name, chargerPriority, outputSource = MODE_SETTINGS[value]
+            logging.info("setting mode to {}".format(name))
+            writes = [setChargerPriority(self._inverter, chargerPriority), setOutputSource(self._inverter, outputSource)]
+            # Acknowledged from the main loop once the inverter answered
+            previous = self._dbusinverter[path]
+            writes[-1].add_done_callback(lambda _: GLib.idle_add(self._write_done, path, value, previous, writes))
         return True # accept the change
 
+    def _write_done(self, path, value, previous, writes):
+        # The writes of one change run in order, all of them are done
+        errors = [write.exception() for write in writes if write.exception() is not None]
+        if errors:
+            logging.warning(f"{path} = {value} not applied by the inverter ({errors[0]}), back to {previous}")
+            self._dbusinverter[path] = previous
+        else:
+            logging.info(f"{path} = {value} applied")
+            self._schedule.invalidate('get-rated')
+            self._queued_updates.append((path, value))
+        return False
+
+def replay(service, path, speed=0):
+    """
+    Publish a TelemetryRecorder file through the service, `speed` times
+    faster than recorded (0: as fast as the main loop goes), then quit.
+    """
+    samples = read_recording(path)
+    started = time.monotonic()
+    first = None
+    count = 0
+
+    def publish(results):
+        nonlocal count
+        service._publish_PI18(results)
+        count += 1
+        return schedule()
+
+    def schedule():
+        nonlocal first
+        sample = next(samples, None)
+        if sample is None:
+            elapsed = time.monotonic() - started
+            logging.warning(f"Replayed {count} samples in {elapsed:.2f} s ({count / max(elapsed, 1e-6):.0f}/s), "
+                            f"publishing: {service._publishFilter.stats()}")
+            mainloop.quit()
+            return False
+        timestamp, results = sample
+        if first is None:
+            first = timestamp
+        delay = started + (timestamp - first) / speed - time.monotonic() if speed else 0
+        if delay > 0:
+            GLib.timeout_add(int(delay * 1000), publish, results)
+        else:
+            GLib.idle_add(publish, results)
+        return False
+
+    schedule()
+
+# Seconds between checks for inverters plugged in after an --all start
+HOTPLUG_INTERVAL = 10
+
+def runtime_report(started, inverters):
+    """Log the footprint of the process: RSS, CPU time and an estimate of the GC-tracked allocation rate."""
+    uptime = max(time.monotonic() - started, 1)
+    memory = {}
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    memory[line[:5]] = int(line.split()[1])
+    except OSError:
+        pass
+    times = os.times()
+    cpu = times.user + times.system
+    # Any collection follows `threshold` more GC-tracked (container) objects
+    # allocated than freed: a lower bound of their rate, not every allocation
+    allocations = sum(generation['collections'] for generation in gc.get_stats()) * gc.get_threshold()[0]
+    logging.warning(f"Runtime {uptime:.0f} s for {inverters} inverter(s): RSS {memory.get('VmRSS')} kB (peak {memory.get('VmHWM')} kB), "
+                    f"CPU {cpu:.1f} s ({100 * cpu / uptime:.2f} %), {allocations / uptime:.0f} GC-tracked allocations/s (est.), "
+                    f"{sys.getallocatedblocks()} blocks in use")
+
 def main():
+    started = time.monotonic()
     parser = argparse.ArgumentParser()
-    parser.add_argument("--serial","-s", required=True, type=str)
+    parser.add_argument("--serial","-s", type=str)
+    parser.add_argument("--all","-a", action='store_true', help="handle every inverter of the config file in this process")
+    parser.add_argument("--config","-c", type=str, default='/data/etc/dbus-mppsolar/config.json')
+    parser.add_argument("--stats-file", type=str, help="where SIGUSR1 dumps the statistics as JSON")
+    parser.add_argument("--replay", type=str, help="publish a telemetry recording instead of polling the inverter of --serial")
+    parser.add_argument("--replay-speed", type=float, default=0, help="replay speed factor, 0 (default) replays as fast as possible")
+    parser.add_argument("--slim", action='store_true', help="low footprint: no per command statistics on D-Bus, startup objects left out of the GC")
     global args
     args = parser.parse_args()
+    if not args.serial and not args.all:
+        parser.error("one of --serial or --all is required")
+    if args.replay and not args.serial:
+        parser.error("--replay requires --serial")
 
     from dbus.mainloop.glib import DBusGMainLoop
     # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
     DBusGMainLoop(set_as_default=True)
 
-    mppservice = DbusMppSolarService(tty=args.serial, deviceinstance=0)
+    atexit.register(stop_inverterd)  # S'assure que inverterd est tué à la fin du script
+
+    mppservices = []
+    def add_service(service):
+        mppservices.append(service)
+        atexit.register(service._history.close)
+        if service._recorder:
+            atexit.register(service._recorder.close)
+
+    if args.all:
+        # One service per connected inverter, each polled from its own worker
+        with open(args.config, 'r') as json_file:
+            config = json.load(json_file)
+        parallel = ParallelController(config)
+        unplugged = []
+
+        def attach(tty):
+            # A device gone again meanwhile only waits for the next check
+            try:
+                add_service(DbusMppSolarService(tty=tty, deviceinstance=0, json_file_path=args.config, asyncPoll=True, parallel=parallel, slim=args.slim))
+            except InverterNotConnected as e:
+                logging.warning(e)
+                unplugged.append(tty)
+
+        for tty in config:
+            if not os.path.exists(tty):
+                logging.warning("Inverter not connected on {}".format(tty))
+                unplugged.append(tty)
+                continue
+            attach(tty)
+
+        # Inverters of the config plugged in later are attached as they show up
+        def attach_plugged():
+            for tty in [tty for tty in unplugged if os.path.exists(tty)]:
+                logging.warning("Inverter connected on {}".format(tty))
+                unplugged.remove(tty)
+                attach(tty)
+            return bool(unplugged)
+        if unplugged:
+            GLib.timeout_add(HOTPLUG_INTERVAL * 1000, attach_plugged)
+        elif not mppservices:
+            sys.exit()
+    else:
+        try:
+            add_service(DbusMppSolarService(tty=args.serial, deviceinstance=0, json_file_path=args.config, replay=bool(args.replay), slim=args.slim))
+        except InverterNotConnected as e:
+            logging.warning(e)
+            sys.exit()
+    atexit.register(lambda: runtime_report(started, len(mppservices)))
+    if args.slim:
+        # Config, D-Bus items and velib live as long as the process, the
+        # collector does not need to go through them again on every pass
+        gc.collect()
+        gc.freeze()
     logging.info('Created service & connected to dbus, switching over to GLib.MainLoop() (= event based)')
 
+    # kill -USR1 dumps the statistics of every inverter
+    stats_file = args.stats_file or '/tmp/dbus-mppsolar.{}.stats.json'.format('all' if args.all else os.path.basename(args.serial))
+    def dump_stats():
+        with open(stats_file, 'w') as json_file:
+            json.dump({service.tty: service._inverter.stats.as_dict() for service in mppservices}, json_file, indent=2)
+        logging.warning(f"Statistics written to {stats_file}")
+        runtime_report(started, len(mppservices))
+        return True
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, dump_stats)
+
     global mainloop
 
     mainloop = GLib.MainLoop()
+    # svc stops us with SIGTERM, leave the loop so the atexit handlers run
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGTERM, mainloop.quit)
+    if args.replay:
+        replay(mppservices[0], args.replay, args.replay_speed)
     mainloop.run()
 
-    atexit.register(stop_inverterd)  # S'assure que inverterd est tué à la fin du script
-
 if __name__ == "__main__":
     main()
\ No newline at end of file
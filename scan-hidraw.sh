@@ -7,6 +7,15 @@
 ### END INIT INFO
 
 START_SCRIPT="/data/etc/dbus-mppsolar/start-dbus-mppsolar.sh"
+# When this file exists, one process handles every inverter of config.json
+MULTI_DEVICE_FLAG="/data/etc/dbus-mppsolar/multi-device"
+
+if [ -f "$MULTI_DEVICE_FLAG" ]; then
+  # The start script checks whether it is already running
+  echo "Launching dbus-mppsolar for all devices"
+  $START_SCRIPT all &
+  exit 0
+fi
 
 echo "Starting HIDRAW device scan..."
 
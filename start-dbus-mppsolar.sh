@@ -1,10 +1,35 @@
 #!/bin/bash
 
+# Usage: start-dbus-mppsolar.sh <hidrawX|all>
+# "all" handles every inverter of config.json from a single process.
 DEVICE=$1
 SERIAL_DEV="/dev/$DEVICE"
 APP=/data/etc/dbus-mppsolar/dbus-mppsolar.py
 LOGDIR=/var/log/dbus-mppsolar.$DEVICE
 PIDFILE="/var/run/dbus-mppsolar.$DEVICE.pid"
+ALL_PIDFILE="/var/run/dbus-mppsolar.all.pid"
+# When this file exists, one process handles every inverter of config.json
+MULTI_DEVICE_FLAG="/data/etc/dbus-mppsolar/multi-device"
+
+if [ "$DEVICE" = "all" ]; then
+  # A pidfile left by a process that died does not count
+  if [ -f "$ALL_PIDFILE" ] && kill -0 "$(cat "$ALL_PIDFILE")" 2>/dev/null; then
+    echo "UTC-$(date -u +%Y.%m.%d-%H:%M:%S) Already running: all"
+    exit 0
+  fi
+  ARGS="--all"
+else
+  if [ -f "$MULTI_DEVICE_FLAG" ]; then
+    # The multi-device process also attaches inverters plugged in after it started
+    echo "UTC-$(date -u +%Y.%m.%d-%H:%M:%S) $DEVICE is handled by the multi-device service"
+    exec "$0" all
+  fi
+  ARGS="--serial $SERIAL_DEV"
+fi
+# When this file exists, run with the low footprint options
+if [ -f /data/etc/dbus-mppsolar/slim ]; then
+  ARGS="$ARGS --slim"
+fi
 
 echo "UTC-$(date -u +%Y.%m.%d-%H:%M:%S) Starting dbus-mppsolar.py on $DEVICE"
 
@@ -13,4 +38,4 @@ mkdir -p "$LOGDIR"
 exec start-stop-daemon --start \
   --make-pidfile --pidfile "$PIDFILE" \
   --exec /bin/sh -- -c \
-  "exec python3 $APP --serial $SERIAL_DEV 2>&1 | multilog t s25000 n4 $LOGDIR"
+  "exec python3 $APP $ARGS 2>&1 | multilog t s25000 n4 $LOGDIR"